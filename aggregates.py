@@ -0,0 +1,119 @@
+# Pre-aggregated rollups of songplays for dashboard queries.
+# Each rollup is a materialized view counting plays per time bucket (hour or
+# day) and a few songplays columns. They aggregate songplays alone with
+# count(*), so Redshift refreshes them incrementally from the rows merged
+# since the last refresh. route() picks the smallest rollup able to answer
+# a question; plays are additive, so a finer rollup is summed up when needed.
+
+GRAINS = ['hour', 'day', 'week', 'month', 'year']
+
+
+class Rollup:
+    """One materialized view over songplays.
+        grain      - time bucket of start_time, 'hour' or 'day'
+        dimensions - songplays columns grouped by
+        sortkey    - leading sort key column, defaults to the time bucket
+    """
+
+    def __init__(self, name, grain, dimensions, sortkey=None):
+        if grain not in GRAINS:
+            raise ValueError("{} : unknown grain '{}'".format(name, grain))
+        self.name = name
+        self.grain = grain
+        self.dimensions = list(dimensions)
+        self.sortkey = sortkey or 'period'
+
+    def create_sql(self):
+        columns = ", ".join(self.dimensions)
+        return """CREATE MATERIALIZED VIEW {name}
+                  SORTKEY ({sortkey})
+                  AUTO REFRESH NO
+                  AS
+                  select date_trunc('{grain}', start_time) as period, {columns}, count(*) as plays
+                    from songplays
+                   group by date_trunc('{grain}', start_time), {columns}""".format(
+            name=self.name, sortkey=self.sortkey, grain=self.grain, columns=columns)
+
+    def refresh_sql(self):
+        return "REFRESH MATERIALIZED VIEW {}".format(self.name)
+
+    def drop_sql(self):
+        return "DROP MATERIALIZED VIEW IF EXISTS {}".format(self.name)
+
+
+# ordered from the smallest to the largest expected row count
+rollups = [
+    Rollup('plays_day_level_location',  'day',  ['level', 'location']),
+    Rollup('plays_day_artist',          'day',  ['artist_id']),
+    Rollup('plays_day_song',            'day',  ['song_id', 'artist_id']),
+    Rollup('plays_hour_level_location', 'hour', ['level', 'location']),
+    Rollup('plays_day_user',            'day',  ['user_id', 'level']),
+    Rollup('plays_hour_song',           'hour', ['song_id', 'artist_id']),
+]
+
+
+def ensure_rollups(cur, redshift=True, rollup_list=rollups):
+    """This function creates the rollups that do not exist yet (materialized
+    views have no IF NOT EXISTS). Returns the names created.
+    """
+    if redshift:
+        cur.execute("select name from stv_mv_info")
+    else:
+        cur.execute("select matviewname from pg_matviews")
+    existing = {row[0].strip() for row in cur.fetchall()}
+    created = []
+    for rollup in rollup_list:
+        if rollup.name not in existing:
+            cur.execute(rollup.create_sql())
+            created.append(rollup.name)
+    return created
+
+
+def route(dimensions=(), grain='day', sizes=None, rollup_list=rollups):
+    """This function returns the smallest rollup grouped by every column of
+    'dimensions' at 'grain' or finer, None when only songplays answers.
+        sizes - optional dict of rollup name -> row count (e.g. from
+                rollup_sizes()); rollups are otherwise taken in list order
+    """
+    if grain not in GRAINS:
+        raise ValueError("unknown grain '{}'".format(grain))
+    candidates = [rollup for rollup in rollup_list
+                  if set(dimensions) <= set(rollup.dimensions)
+                  and GRAINS.index(rollup.grain) <= GRAINS.index(grain)]
+    if sizes:
+        candidates.sort(key=lambda rollup: sizes.get(rollup.name, float('inf')))
+    return candidates[0] if candidates else None
+
+
+def rollup_sizes(cur, rollup_list=rollups):
+    """This function returns rollup name -> row count from svv_table_info
+    (Redshift), i.e. without scanning the rollups. The rows of a materialized
+    view live in an internal table named mv_tbl__<view name>__<n>.
+    """
+    cur.execute("""select "table", tbl_rows from svv_table_info where "table" like 'mv\\_tbl\\_\\_%'""")
+    names = {rollup.name for rollup in rollup_list}
+    sizes = {}
+    for table, rows in cur.fetchall():
+        name = table.strip()[len('mv_tbl__'):].rsplit('__', 1)[0]
+        if name in names:
+            sizes[name] = sizes.get(name, 0) + rows
+    return sizes
+
+
+def plays_query(dimensions=(), grain='day', where=None, sizes=None, rollup_list=rollups):
+    """This function returns the SQL counting plays per 'grain' bucket and
+    'dimensions', answered from the smallest suitable rollup, or from
+    songplays when none fits.
+        where - optional filter on the dimensions and 'period'
+    """
+    rollup = route(dimensions, grain, sizes, rollup_list)
+    if rollup:
+        source, plays = rollup.name, "sum(plays)"
+    else:
+        source, plays = "(select {} from songplays) s".format(
+            ", ".join(["start_time as period"] + list(dimensions))), "count(*)"
+    period = "date_trunc('{}', period)".format(grain)
+    sql = "select {}, {} as plays from {}".format(", ".join([period + " as period"] + list(dimensions)), plays, source)
+    if where:
+        sql += " where {}".format(where)
+    return sql + " group by {}".format(", ".join([period] + list(dimensions)))
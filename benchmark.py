@@ -0,0 +1,211 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from calendar_hours import ensure_calendar, staged_time_range
+from connection_pool import ConnectionPool
+from aggregates import ensure_rollups
+from datagen import write_feeds
+from instrument import InstrumentedCursor, RunMetrics
+from ledger import RunLedger, run_checkpointed
+from preprocess import preprocess_feed
+from quality import report, run_checks, select_checks
+from run_context import RunContext
+from schema import stg_events_spec
+from sql_queries import query_names, create_table_queries, drop_table_queries, process_table_graph, process_table_chains, partitioned_chains
+
+
+# Offline benchmark of the ETL against a local PostgreSQL (15+ for MERGE).
+# Redshift-only DDL is shimmed, COPY from S3 is replaced by COPY FROM STDIN
+# of the preprocess.py chunks, and the merge chains run unchanged through
+# the scheduler & connection pool.
+
+SHIMS = [
+    (re.compile(r'\s+ENCODE\s+\w+', re.I), ''),
+    (re.compile(r'\s+DISTSTYLE\s+\w+', re.I), ''),
+    (re.compile(r'\s+DISTKEY\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\s+DISTKEY\b', re.I), ''),
+    (re.compile(r'\s+(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\s+SORTKEY\b', re.I), ''),
+    (re.compile(r'\s+AUTO\s+REFRESH\s+(YES|NO)\b', re.I), ''),
+    (re.compile(r'IDENTITY\s*\(\s*0\s*,\s*1\s*\)', re.I), 'GENERATED BY DEFAULT AS IDENTITY (START WITH 0 MINVALUE 0)'),
+]
+
+
+def shim_redshift(sql):
+    """This function rewrites Redshift-only syntax into PostgreSQL"""
+    for pattern, replacement in SHIMS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class ShimCursor:
+    """Cursor wrapper applying shim_redshift to every statement"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def execute(self, query, vars=None):
+        self._cursor.execute(shim_redshift(query), vars)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_local(pool, chunks):
+    """This function is the local stand-in for the staging COPYs : chunks are
+    streamed with COPY FROM STDIN. stg_events.ts is converted from epoch
+    milliseconds the way COPY timeformat 'epochmillisecs' does.
+        chunks - dict of feed name -> list of gzip CSV paths
+    """
+    columns = [column.name for column in stg_events_spec.columns]
+    converted = ["(timestamp 'epoch' + ts * interval '1 millisecond')" if name == 'ts' else name
+                 for name in columns]
+    with pool.transaction() as cur:
+        cur.execute("TRUNCATE stg_events, stg_songs")
+        cur.execute("CREATE TEMP TABLE stg_events_load (LIKE stg_events)")
+        cur.execute("ALTER TABLE stg_events_load ALTER COLUMN ts TYPE bigint USING NULL")
+        for feed, table in (('log_data', 'stg_events_load'), ('song_data', 'stg_songs')):
+            for path in chunks[feed]:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    cur.copy_expert("COPY {} FROM STDIN WITH (FORMAT csv)".format(table), f)
+        cur.execute("INSERT INTO stg_events ({}) SELECT {} FROM stg_events_load".format(
+            ", ".join(columns), ", ".join(converted)))
+        cur.execute("DROP TABLE stg_events_load")
+
+
+def run_benchmark(dsn, num_events, work_dir, num_songs=None, num_users=None, workers=4, seed=0):
+    """This function runs every stage once and returns the result record :
+    seconds and events/s per stage, per merge chain and in total
+    """
+    stages = {}
+
+    def stage(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stages[name] = time.perf_counter() - start
+        print("{:<20} {:>8.2f}s".format(name, stages[name]))
+        return result
+
+    metrics = RunMetrics('benchmark', os.path.join(work_dir, 'metrics'))
+    pool = ConnectionPool(dsn, maxconn=workers,
+                          wrap_cursor=lambda cur: InstrumentedCursor(ShimCursor(cur), metrics, query_names, query_ids=False))
+    try:
+        data_dir = os.path.join(work_dir, 'data')
+        stage('generate', write_feeds, data_dir, num_events, num_songs, num_users, seed)
+
+        chunks = {}
+        for feed in ('log_data', 'song_data'):
+            paths, _ = stage('preprocess_' + feed, preprocess_feed, feed, os.path.join(data_dir, feed),
+                             os.path.join(work_dir, 'chunks', feed), workers)
+            chunks[feed] = paths
+
+        def schema():
+            with pool.transaction() as cur:
+                for query in drop_table_queries + create_table_queries:
+                    cur.execute(query)
+                ensure_rollups(cur, redshift=False)
+        stage('schema', schema)
+        stage('load', load_local, pool, chunks)
+
+        def calendar():
+            with pool.transaction() as cur:
+                time_range = staged_time_range(cur)
+                if time_range:
+                    ensure_calendar(cur, *time_range)
+        stage('calendar', calendar)
+
+        ledger = RunLedger(pool, resume=False)
+        ledger.start()
+        timings = stage('merge', run_checkpointed, pool, ledger, RunContext(None), process_table_graph,
+                        process_table_chains, partitioned_chains, query_names, workers)
+
+        def quality():
+            with pool.transaction() as cur:
+                return report(run_checks(cur, select_checks(), ledger.run_id))
+        failed = stage('quality', quality)
+        if failed:
+            raise RuntimeError("data-quality check(s) failed : {}".format(", ".join(result.name for result in failed)))
+        ledger.finish()
+        for name, seconds in timings.items():
+            stages['merge_' + name] = seconds
+    finally:
+        pool.closeall()
+        metrics.write()
+
+    stages['total'] = sum(seconds for name, seconds in stages.items() if not name.startswith('merge_'))
+    return {'commit'    : git_commit(),
+            'timestamp' : datetime.now(timezone.utc).isoformat(),
+            'events'    : num_events,
+            'stages'    : {name: {'seconds'      : round(seconds, 4),
+                                  'events_per_s' : round(num_events / seconds, 1) if seconds else None}
+                           for name, seconds in stages.items()}}
+
+
+def find_regressions(result, history, threshold=0.2, min_delta=0.5):
+    """This function compares a result with the latest earlier run of the
+    same scale and returns (stage, previous seconds, seconds) for every stage
+    slower by more than 'threshold' (0.2 = 20%) and by at least 'min_delta'
+    seconds, so the jitter of sub-second stages is not reported
+    """
+    previous = [run for run in history if run['events'] == result['events']]
+    if not previous:
+        return []
+    baseline = previous[-1]['stages']
+    regressions = []
+    for name, current in result['stages'].items():
+        before = baseline.get(name)
+        if (before and before['seconds'] and current['seconds'] > before['seconds'] * (1 + threshold)
+                and current['seconds'] - before['seconds'] >= min_delta):
+            regressions.append((name, before['seconds'], current['seconds']))
+    return regressions
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ETL benchmark against a local PostgreSQL")
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DSN', 'host=localhost dbname=postgres user=postgres'))
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--songs', type=int)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--workdir', default='bench_work')
+    parser.add_argument('--history', default='bench_history.jsonl')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-delta', type=float, default=0.5)
+    args = parser.parse_args()
+
+    result = run_benchmark(args.dsn, args.events, args.workdir, args.songs, args.users, args.workers)
+    regressions = find_regressions(result, read_history(args.history), args.threshold, args.min_delta)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    for name, stats in result['stages'].items():
+        print("{:<24} {:>8.2f}s {:>12} events/s".format(name, stats['seconds'], stats['events_per_s']))
+    for name, before, after in regressions:
+        print("REGRESSION {:<24} {:.2f}s -> {:.2f}s".format(name, before, after))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+
+def calendar_rows(start, end):
+    """This function yields one calendar_hours row per hour from the start of
+    the year of 'start' up to the end of the year of 'end'. Attributes match
+    Redshift EXTRACT : ISO week, weekday 0 = Sunday.
+    """
+    hour = datetime(start.year, 1, 1)
+    stop = datetime(end.year + 1, 1, 1)
+    while hour < stop:
+        yield (hour, hour.hour, hour.day, hour.isocalendar()[1], hour.month, hour.year, hour.isoweekday() % 7)
+        hour += timedelta(hours=1)
+
+
+def ensure_calendar(cur, start, end, batch_size=1000):
+    """This function makes sure calendar_hours covers every hour between
+    'start' and 'end'. Missing years are generated once and inserted in
+    batches; years already present are left alone, so the table is reused
+    across runs. Returns the number of rows inserted.
+    """
+    cur.execute("select distinct extract(year from hour_start)::int from calendar_hours")
+    present = {row[0] for row in cur.fetchall()}
+    inserted = 0
+    for year in range(start.year, end.year + 1):
+        if year in present:
+            continue
+        rows = list(calendar_rows(datetime(year, 1, 1), datetime(year, 1, 1)))
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+            cur.execute("INSERT INTO calendar_hours (hour_start, hour, day, week, month, year, weekday) VALUES " + values,
+                        [value for row in batch for value in row])
+        inserted += len(rows)
+    return inserted
+
+
+def staged_time_range(cur):
+    """This function returns (min ts, max ts) of stg_events, or None when empty"""
+    cur.execute("select min(ts), max(ts) from stg_events")
+    low, high = cur.fetchone()
+    return None if low is None else (low, high)
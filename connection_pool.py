@@ -0,0 +1,193 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+
+def dsn_from_config(config, host):
+    """This function builds the psycopg2 connection string for the cluster
+    endpoint 'host' from the [DWH] section of dwh.cfg
+    """
+    return "host={} dbname={} user={} password={} port={}".format(host,
+                                                                 config.get("DWH","DB_NAME"),
+                                                                 config.get("DWH","DB_USER"),
+                                                                 config.get("DWH","DB_PASSWORD"),
+                                                                 config.get("DWH","DB_PORT"))
+
+
+def pool_from_config(config, host, wrap_cursor=None, maxconn=None):
+    """This function creates a ConnectionPool for the cluster endpoint 'host'.
+    Pool size comes from the [POOL] section of dwh.cfg unless 'maxconn' is
+    given, and every key of the [SESSION] section is applied as a session
+    setting, e.g.
+        [SESSION]
+        statement_timeout = 3600000
+        wlm_query_slot_count = 2
+    """
+    settings = dict(config.items("SESSION")) if config.has_section("SESSION") else {}
+    return ConnectionPool(dsn_from_config(config, host),
+                          minconn=config.getint("POOL", "MIN_CONN", fallback=1),
+                          maxconn=maxconn or config.getint("POOL", "MAX_CONN", fallback=4),
+                          settings=settings,
+                          health_check_seconds=config.getint("POOL", "HEALTH_CHECK_SECONDS", fallback=30),
+                          wrap_cursor=wrap_cursor)
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections to the cluster.
+        - callers block while all 'maxconn' connections are checked out
+        - 'minconn' connections are opened up front; every connection
+          returned stays open for reuse, up to 'maxconn', so parallel chains
+          do not reconnect
+        - session settings are applied once, when a connection is opened
+        - a connection idle for more than 'health_check_seconds' is pinged
+          before reuse and replaced if it is no longer usable
+        - 'wrap_cursor', when given, wraps every cursor handed out by
+          transaction(), e.g. to instrument it
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=4, settings=None, health_check_seconds=30, wrap_cursor=None):
+        self._dsn = dsn
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._settings = settings or {}
+        self._health_check_seconds = health_check_seconds
+        self._wrap_cursor = wrap_cursor
+        self._lock = threading.Lock()
+        self._closed = False
+        # idle connections, as (connection, last used), the latest used last
+        self._idle = [(self._connect(), time.monotonic()) for _ in range(min(minconn, maxconn))]
+
+    def _connect(self):
+        # a connection enters the pool with its session settings applied
+        conn = psycopg2.connect(self._dsn)
+        try:
+            cur = conn.cursor()
+            for name, value in self._settings.items():
+                cur.execute("SET {} TO %s".format(name), (value,))
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self._health_check_seconds:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("select 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """This function checks a connection out of the pool, blocking while
+        the pool is exhausted. Pair every call with putconn().
+        """
+        self._slots.acquire()
+        try:
+            with self._lock:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                return self._connect()
+            conn, last_used = idle
+            if not self._is_healthy(conn, last_used):
+                print("Replacing stale connection")
+                self._close(conn)
+                conn = self._connect()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """This function returns a connection to the pool. Any transaction
+        still open on it is rolled back; a broken connection is closed.
+        """
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        with self._lock:
+            keep = not (close or conn.closed or self._closed)
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+        if not keep:
+            self._close(conn)
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """Context manager yielding a pooled connection for the block"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Context manager yielding a cursor whose statements all commit
+        together at the end of the block, or roll back if it raises
+        """
+        with self.session() as conn:
+            cur = conn.cursor()
+            if self._wrap_cursor:
+                cur = self._wrap_cursor(cur)
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def sandbox(self):
+        """Context manager yielding a cursor whose statements are always
+        rolled back at the end of the block, e.g. work tables created only
+        to EXPLAIN the statements reading them
+        """
+        with self.session() as conn:
+            cur = conn.cursor()
+            try:
+                yield self._wrap_cursor(cur) if self._wrap_cursor else cur
+            finally:
+                conn.rollback()
+
+    @contextmanager
+    def autocommit(self):
+        """Context manager yielding a cursor whose statements each commit on
+        their own, for statements Redshift refuses to run inside a transaction
+        block (VACUUM, ALTER COLUMN TYPE, ALTER DISTKEY...)
+        """
+        with self.session() as conn:
+            conn.autocommit = True
+            try:
+                cur = conn.cursor()
+                yield self._wrap_cursor(cur) if self._wrap_cursor else cur
+            finally:
+                conn.autocommit = False
+
+    def closeall(self):
+        """Closes the idle connections; those still checked out are closed
+        when returned
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
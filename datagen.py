@@ -0,0 +1,157 @@
+import json
+import os
+import random
+import string
+import sys
+from functools import lru_cache, partial
+from datetime import datetime, timezone
+
+
+# Synthetic Sparkify feeds, shaped like the udacity-dend log_data & song_data
+# JSON. Song popularity follows a Zipf-like skew and a fixed pool of users
+# keeps coming back, so the merges see realistic duplicate keys.
+
+PAGES = [('NextSong', 80), ('Home', 8), ('Logout', 3), ('Login', 3), ('Settings', 2), ('Upgrade', 2), ('Help', 2)]
+USER_AGENTS = ['Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36',
+               'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Version/7.0.6 Safari/537.78.2',
+               'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'New York-Newark-Jersey City, NY-NJ-PA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Portland-South Portland, ME', 'Lansing-East Lansing, MI']
+
+
+def _word(rng, low=3, high=10):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(low, high))).capitalize()
+
+
+def make_artist(n, seed=0):
+    """This function returns artist 'n' of the catalog; the same (n, seed)
+    always gives the same artist
+    """
+    rng = random.Random("{}:artist:{}".format(seed, n))
+    return {'artist_id'        : 'AR{:016X}'.format(n),
+            'artist_name'      : ' '.join(_word(rng) for _ in range(rng.randint(1, 3))),
+            'artist_location'  : rng.choice(LOCATIONS + ['']),
+            'artist_latitude'  : round(rng.uniform(-60, 60), 5) if rng.random() < 0.6 else None,
+            'artist_longitude' : round(rng.uniform(-150, 150), 5) if rng.random() < 0.6 else None}
+
+
+def make_song(n, num_artists, seed=0):
+    """This function returns song 'n' of the catalog as a song_data record;
+    the same (n, num_artists, seed) always gives the same song, so the catalog
+    never has to be held in memory
+    """
+    rng = random.Random("{}:song:{}".format(seed, n))
+    record = {'num_songs' : 1,
+              'song_id'   : 'SO{:016X}'.format(n),
+              'title'     : ' '.join(_word(rng) for _ in range(rng.randint(1, 4))),
+              'duration'  : round(rng.uniform(60, 600), 5),
+              'year'      : rng.choice([0, rng.randint(1960, 2018)])}
+    record.update(make_artist(rng.randrange(num_artists), seed))
+    return record
+
+
+def iter_events(num_songs, num_artists, num_events, num_users, start, seed=0, skew=1.2):
+    """This function yields 'num_events' log_data records in time order.
+    Songs of the make_song catalog are drawn with a Zipf-like skew (weight
+    1 / rank ** skew) and users from a pool of 'num_users' that each keep
+    their name and gender and sometimes change level.
+    """
+    rng = random.Random(seed)
+    # the skew makes a few thousand songs most of the draws
+    song_at = lru_cache(maxsize=4096)(partial(make_song, num_artists=num_artists, seed=seed))
+    cum_weights, total = [], 0.0
+    for rank in range(num_songs):
+        total += 1.0 / (rank + 1) ** skew
+        cum_weights.append(total)
+    users = [{'userId'    : str(n + 1),
+              'firstName' : _word(rng),
+              'lastName'  : _word(rng),
+              'gender'    : rng.choice('MF'),
+              'level'     : rng.choice(['free', 'paid']),
+              'location'  : rng.choice(LOCATIONS),
+              'userAgent' : rng.choice(USER_AGENTS),
+              'registration' : float(rng.randint(1530000000000, 1540000000000)),
+              'sessionId' : rng.randint(1, 1000)}
+             for n in range(num_users)]
+    pages, page_weights = zip(*PAGES)
+    ts = int(start.timestamp() * 1000)
+    batch = 1000
+    for offset in range(0, num_events, batch):
+        picks = rng.choices(range(num_songs), cum_weights=cum_weights, k=min(batch, num_events - offset))
+        for n in picks:
+            song = song_at(n)
+            ts += rng.randint(1, 30000)
+            user = rng.choice(users)
+            if rng.random() < 0.001:
+                user['level'] = 'paid' if user['level'] == 'free' else 'free'
+            if rng.random() < 0.01:
+                user['sessionId'] += 1000
+            page = rng.choices(pages, weights=page_weights)[0]
+            next_song = page == 'NextSong'
+            yield {'artist'        : song['artist_name'] if next_song else None,
+                   'auth'          : 'Logged In',
+                   'firstName'     : user['firstName'],
+                   'gender'        : user['gender'],
+                   'itemInSession' : rng.randint(0, 100),
+                   'lastName'      : user['lastName'],
+                   'length'        : song['duration'] if next_song else None,
+                   'level'         : user['level'],
+                   'location'      : user['location'],
+                   'method'        : 'PUT' if next_song else 'GET',
+                   'page'          : page,
+                   'registration'  : user['registration'],
+                   'sessionId'     : user['sessionId'],
+                   'song'          : song['title'] if next_song else None,
+                   'status'        : 200,
+                   'ts'            : ts,
+                   'userAgent'     : user['userAgent'],
+                   'userId'        : user['userId']}
+
+
+def write_feeds(out_dir, num_events, num_songs=None, num_users=None, seed=0,
+                start=datetime(2018, 11, 1, tzinfo=timezone.utc)):
+    """This function writes a synthetic dataset under out_dir/song_data and
+    out_dir/log_data (one JSON-lines file per day of events). Songs and
+    events are both streamed : only one popularity weight per song is held
+    in memory. Returns (song count, event count).
+    """
+    num_songs = num_songs or max(100, num_events // 20)
+    num_users = num_users or max(10, num_events // 1000)
+    num_artists = max(10, num_songs // 3)
+
+    song_dir = os.path.join(out_dir, 'song_data')
+    os.makedirs(song_dir, exist_ok=True)
+    per_file = 1000
+    for offset in range(0, num_songs, per_file):
+        with open(os.path.join(song_dir, 'songs.{:06d}.json'.format(offset // per_file)), 'w') as f:
+            for n in range(offset, min(offset + per_file, num_songs)):
+                f.write(json.dumps(make_song(n, num_artists, seed)) + '\n')
+
+    log_dir = os.path.join(out_dir, 'log_data')
+    os.makedirs(log_dir, exist_ok=True)
+    day, f = None, None
+    try:
+        for event in iter_events(num_songs, num_artists, num_events, num_users, start, seed):
+            event_day = datetime.fromtimestamp(event['ts'] / 1000, timezone.utc).date()
+            if event_day != day:
+                if f:
+                    f.close()
+                day = event_day
+                f = open(os.path.join(log_dir, '{}-events.json'.format(day.isoformat())), 'w')
+            f.write(json.dumps(event) + '\n')
+    finally:
+        if f:
+            f.close()
+    return num_songs, num_events
+
+
+def main():
+    """python datagen.py <out dir> <events> [songs] [users]"""
+    out_dir, num_events = sys.argv[1], int(sys.argv[2])
+    num_songs = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    num_users = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    print("{} songs, {} events written".format(*write_feeds(out_dir, num_events, num_songs, num_users)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+
+from merge_builder import MergeSpec, ranked_source
+
+
+# Client-side change detection for the slowly changing dimensions (songs,
+# artists). A local sqlite store keeps one content digest per key already
+# merged. Each run only fetches the (key, digest) pairs of the staged rows,
+# pushes the keys that are new or changed to stg_changed_keys, and merges
+# those keys alone; a dimension with no changed key skips its chain, and a
+# dimension where most keys changed (cold cache) keeps its full merge.
+
+def _digest_expression(columns):
+    return "md5({})".format(" || '|' || ".join("coalesce(cast({} as varchar), '~')".format(column)
+                                               for column in columns))
+
+
+def digest_sql(spec, source=None):
+    """This function returns the query listing (key, content digest) of
+    'source', by default the staged rows of the MergeSpec as the merge keeps
+    them : one row, hence one digest, per key (see ranked_source), whatever
+    the number or order of the staged variants of that key
+    """
+    key = spec.keys[0]
+    return "select cast({key} as varchar), {digest} from ({source}) src where {key} is not null".format(
+        key=key, digest=_digest_expression([column for column in spec.columns if column != key]),
+        source=source or ranked_source(spec))
+
+
+def changed_keys_spec(spec, dimension):
+    """This function returns a MergeSpec like 'spec' whose source is limited
+    to the keys pushed to stg_changed_keys for 'dimension'
+    """
+    source = """select * from ({}) src
+                 where cast({} as varchar) in (select key_value from stg_changed_keys
+                                                where dimension = '{}')""".format(spec.source, spec.keys[0], dimension)
+    return MergeSpec(spec.target, source, spec.columns, spec.keys, spec.update, spec.latest_by, spec.insert_columns,
+                     spec.target_filter)
+
+
+class DimensionCache:
+    """Local sqlite store of dimension key -> content digest, plus the row
+    count of the target table when the digests were recorded, so a target
+    rebuilt or changed outside the etl invalidates its digests.
+    """
+
+    def __init__(self, path='dim_cache.db'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS dimension_digests
+                                       (dimension text NOT NULL,
+                                        key       text NOT NULL,
+                                        digest    text NOT NULL,
+                                        PRIMARY KEY (dimension, key))""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS dimension_rows
+                                       (dimension text PRIMARY KEY,
+                                        row_count integer NOT NULL)""")
+
+    def digests(self, dimension):
+        with self._lock:
+            return dict(self._conn.execute("select key, digest from dimension_digests where dimension = ?",
+                                           (dimension,)).fetchall())
+
+    def row_count(self, dimension):
+        with self._lock:
+            row = self._conn.execute("select row_count from dimension_rows where dimension = ?",
+                                     (dimension,)).fetchone()
+            return row[0] if row else None
+
+    def reset(self, dimension):
+        with self._lock, self._conn:
+            self._conn.execute("delete from dimension_digests where dimension = ?", (dimension,))
+            self._conn.execute("delete from dimension_rows where dimension = ?", (dimension,))
+
+    def record(self, dimension, digests, row_count):
+        """Records 'digests' (key -> digest) and the target row count"""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO dimension_digests (dimension, key, digest) VALUES (?, ?, ?)",
+                                   [(dimension, key, digest) for key, digest in digests.items()])
+            self._conn.execute("INSERT OR REPLACE INTO dimension_rows (dimension, row_count) VALUES (?, ?)",
+                               (dimension, row_count))
+
+    def close(self):
+        self._conn.close()
+
+
+def _push_keys(cur, dimension, keys, batch_size=1000):
+    cur.execute("delete from stg_changed_keys where dimension = %s", (dimension,))
+    keys = sorted(keys)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        cur.execute("INSERT INTO stg_changed_keys (dimension, key_value) VALUES {}".format(
+            ", ".join(["(%s, %s)"] * len(batch))), [value for key in batch for value in (dimension, key)])
+
+
+def plan_dimension_changes(cur, cache, dimensions, chains, changed_chains, full_merge_ratio=0.5):
+    """This function compares the staged rows of each cached dimension with
+    the local digests and rewrites 'chains' (dict of chain name -> list of
+    statements, changed in place) :
+        no changed key   -> chain emptied (nothing to merge)
+        some changed key -> keys pushed to stg_changed_keys, and the chain
+                            replaced by its 'changed_chains' version, limited
+                            to those keys (see changed_keys_spec)
+        most keys changed (more than 'full_merge_ratio' of the staged keys,
+        e.g. a cold cache) -> chain left as is : the full merge is cheaper
+                            than pushing and joining most of the catalog
+        dimensions - dict of chain name -> MergeSpec
+    Digests of a dimension whose target row count differs from the count
+    recorded with them are discarded first. Returns the pending updates to
+    pass to commit_dimension_changes() once the chains have committed.
+    """
+    pending = {}
+    for name, spec in dimensions.items():
+        cur.execute("select count(*) from {}".format(spec.target))
+        rows = cur.fetchone()[0]
+        if cache.row_count(spec.target) != rows:
+            cache.reset(spec.target)
+        known = cache.digests(spec.target)
+
+        cur.execute(digest_sql(spec))
+        staged = cur.fetchall()
+        changed = {}
+        for key, digest in staged:
+            if known.get(key) != digest:
+                changed[key] = digest
+        print("{} : {} changed key(s) of {}".format(spec.target, len(changed), len(staged)))
+        if not changed:
+            chains[name] = []
+            continue
+        pending[name] = changed
+        if len(changed) > full_merge_ratio * len(staged):
+            continue
+        _push_keys(cur, spec.target, changed)
+        chains[name] = changed_chains[name]
+    return pending
+
+
+def skip_derived(chains, derived):
+    """This function empties the chains whose only inputs are chains emptied
+    by plan_dimension_changes()
+        derived - dict of chain name -> chain names it is built from
+    """
+    for name, sources in derived.items():
+        if all(chains.get(source) == [] for source in sources):
+            chains[name] = []
+
+
+def commit_dimension_changes(cur, cache, dimensions, pending):
+    """This function records the merged digests once the chains committed,
+    with the current row count of each target
+    """
+    for name, changed in pending.items():
+        spec = dimensions[name]
+        cur.execute("select count(*) from {}".format(spec.target))
+        cache.record(spec.target, changed, cur.fetchone()[0])
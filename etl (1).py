@@ -1,69 +1,338 @@
-    import configparser
-    import psycopg2
-    import boto3    
-    from sql_queries import copy_table_queries, insert_table_queries, process_table, song_table, user_table, artist_table, time_table, songplay_table
+import configparser
+import os
+import boto3    
+from calendar_hours import ensure_calendar, staged_time_range
+from connection_pool import pool_from_config
+from dimcache import DimensionCache, commit_dimension_changes, plan_dimension_changes, skip_derived
+from instrument import InstrumentedCursor, RunMetrics
+from ledger import WHOLE_LOAD, RunLedger, run_checkpointed
+from load_planner import plan_feed
+from manifest import IngestState, build_manifest, list_objects, plan_incremental, split_s3_url, write_manifest
+from preprocess import preprocess_feed, slice_count, upload_chunks
+from profiles import maintain, maintenance_targets
+from quality import copy_stats, report, run_checks, select_checks
+from run_context import ContextCursor, RunContext, render
+from scheduler import run_dag
+from sql_queries import query_names, copy_table_feeds, truncate_staging_queries, incremental_copy_feeds, packed_copy_feeds, preprocessed_copy_queries, process_table_graph, process_table_chains, partitioned_chains, cached_dimensions, changed_key_chains, cached_derived_chains, query_profiles
 
 
-    def load_staging_tables(cur, conn):
-        """This function execute the COPY statements to load JSON file data
-        into the staging tables STG_EVENTS & STG_SONGS
-        """
-        for query in copy_table_queries:
+def truncate_staging_tables(pool):
+    """This function empties STG_EVENTS & STG_SONGS so that each run only
+    stages the data it loads (TRUNCATE commits on its own in Redshift)
+    """
+    with pool.transaction() as cur:
+        for query in truncate_staging_queries:
             cur.execute(query)
-            conn.commit()
-        cur.execute("select count(*) from stg_events")
-        print(cur.fetchone()[0])
-        cur.execute("select count(*) from stg_songs")
-        print(cur.fetchone()[0])
-
-    def insert_tables(cur, conn):
-        """This function performs the necessary transformations & load targets.
-        Source - stg_events & stg_songs
-        Target - songs, artists, users, time, songplays
-        Load type - designed to do merge, that is load incremental data.
-                For 'users' table alone update of attribute 'level' happens
-        """
-        for tgt in process_table:
-            for query in tgt:
-                cur.execute(query)
-            conn.commit()
-
-
-    def main():
-        config = configparser.ConfigParser()
-        config.read('dwh.cfg')
-        redshift = boto3.client('redshift',
-                       region_name="us-west-2",
-                       aws_access_key_id=config.get('AWS','KEY'),
-                       aws_secret_access_key=config.get('AWS','SECRET')
-                       )
-
-        #This step is to extract the ARN & ENDPOINT information to be used in further steps.
-        myClusterProps = redshift.describe_clusters(ClusterIdentifier=config.get("CLUSTER","CLS_IDENTIFIER"))['Clusters'][0]        
-        aws_arn, aws_clstr = myClusterProps['IamRoles'][0]['IamRoleArn'], myClusterProps['Endpoint']['Address']
-        
-        print(aws_arn)
-        print(type(aws_arn))
-        
-        #Create a connection for the REDSHIFT cluster
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(aws_clstr, 
-                                                                                   config.get("DWH","DB_NAME"),
-                                                                                   config.get("DWH","DB_USER"),
-                                                                                   config.get("DWH","DB_PASSWORD"),
-                                                                                   config.get("DWH","DB_PORT"))
-                               )
-        
-        #Create a cursor for connection
-        cur = conn.cursor()
-        
-        #load JSON data into staging tables in redshift
-        load_staging_tables(cur, conn)
-
-        #process staging table data and perform necesary transformations and load targets.
-        insert_tables(cur, conn)
-
-        conn.close()
-        print("etl.py process completed successfully ! Well done !!")
-
-    if __name__ == "__main__":
-        main()
\ No newline at end of file
+
+def copy_feeds(pool, context, copies):
+    """This function runs the COPY of every feed at the same time, each on
+    its own pooled session, so the smaller load is hidden behind the larger.
+    Rows & files loaded are read from the COPY metadata, not counted.
+        copies    - dict of feed name -> (COPY template, extra RunContext values)
+    """
+    stats = {}
+
+    def copy(feed):
+        template, values = copies[feed]
+        with pool.transaction() as cur:
+            cur.execute(render(template, context.with_values(**values)), name=query_names.get(template))
+            stats[feed] = copy_stats(cur)
+
+    timings = run_dag({feed: [] for feed in copies}, copy, max_workers=max(len(copies), 1))
+    for feed, seconds in timings.items():
+        print("COPY {:<12} {:>8.2f}s {:>12} rows from {} file(s)".format(feed, seconds, stats[feed]['rows'],
+                                                                         stats[feed]['files']))
+    return stats
+
+def load_staging_tables(pool, context):
+    """This function execute the COPY statements to load JSON file data
+    into the staging tables STG_EVENTS & STG_SONGS
+    """
+    truncate_staging_tables(pool)
+    copy_feeds(pool, context, {feed: (template, {}) for feed, template in copy_table_feeds.items()})
+
+def load_staging_planned(pool, context, s3, packed_prefix, manifests=None, state=None):
+    """This function packs the source files of each feed into one gzip file
+    per cluster slice, balanced by size (see load_planner.py), and COPYs the
+    packed files of both feeds at the same time.
+        manifests - optional dict of feed -> local COPY manifest listing the
+                    source files, instead of listing the S3 prefix
+        state     - optional IngestState : the files packed by earlier runs
+                    are reused, only new or changed source files are packed
+    """
+    with pool.session() as conn:
+        num_slices = slice_count(conn.cursor())
+    copies = {}
+    for feed, template in packed_copy_feeds.items():
+        manifest_url = plan_feed(s3, context[feed], num_slices, "{}/{}".format(packed_prefix.rstrip('/'), feed),
+                                 (manifests or {}).get(feed), state=state, feed=feed)
+        copies[feed] = (template, {'manifest_url': manifest_url})
+    truncate_staging_tables(pool)
+    copy_feeds(pool, context, copies)
+
+def load_staging_incremental(pool, context, s3, state, manifest_prefix):
+    """This function loads only the source files not ingested yet.
+    For each feed (log_data, song_data) the S3 prefix is listed, compared
+    with the local ingest state, and a COPY manifest holding only the new
+    files is written under 'manifest_prefix'; the feeds are then loaded at
+    the same time. Returns dict of feed -> files loaded; the caller records
+    them in the ingest state only once the whole load is checkpointed (see
+    load_from_config), so a failed load is planned again in full.
+    """
+    truncate_staging_tables(pool)
+    copies, new_files = {}, {}
+    for feed, copy_template in incremental_copy_feeds.items():
+        source = context[feed]
+        new_objects = plan_incremental(feed, list_objects(s3, source), state)
+        print("{} : {} new file(s)".format(feed, len(new_objects)))
+        if not new_objects:
+            continue
+        bucket, _ = split_s3_url(source)
+        manifest_url = "{}/{}.manifest".format(manifest_prefix.rstrip('/'), feed)
+        write_manifest(s3, manifest_url, build_manifest(bucket, new_objects))
+        copies[feed] = (copy_template, {'manifest_url': manifest_url})
+        new_files[feed] = new_objects
+    copy_feeds(pool, context, copies)
+    return new_files
+
+def load_preprocessed_tables(pool, context, s3, sources, work_dir, s3_prefix, output_format='csv', chunks_per_slice=1):
+    """This function converts the local log_data & song_data JSON feeds into
+    compressed CSV (or Parquet) chunks, uploads them and COPYs the chunks.
+    The chunk count is a multiple of the cluster slice count, so every
+    slice gets an equal share of the load.
+        sources - dict of feed name (log_data, song_data) -> local directory
+    """
+    with pool.session() as conn:
+        num_chunks = slice_count(conn.cursor()) * chunks_per_slice
+    for feed, source_dir in sources.items():
+        paths, rows = preprocess_feed(feed, source_dir, os.path.join(work_dir, feed), num_chunks, output_format)
+        print("{} : {} rows in {} chunk(s)".format(feed, rows, len(paths)))
+        upload_chunks(s3, paths, "{}/{}".format(s3_prefix.rstrip('/'), feed))
+    truncate_staging_tables(pool)
+    copy_feeds(pool, context, {feed: (template, {}) for feed, template in preprocessed_copy_queries[output_format].items()})
+
+def load_from_config(pool, context, s3, config, ledger):
+    """This function loads the staging tables the way the [ETL] section of
+    dwh.cfg asks for :
+        LOAD_FORMAT = csv|parquet pre-processes local copies of the feeds before COPY
+        LOAD_MODE = incremental copies only files not loaded by an earlier run
+        LOAD_MODE = planned packs the source files into balanced gzip files per slice first,
+                    reusing the files packed by earlier runs (STATE_DB)
+        otherwise both feeds are copied in full
+    then records the 'load' checkpoint of the run. Files of an incremental
+    load are recorded pending for the run after that checkpoint committed,
+    and become ingested only when the run ends (commit_ingest_state) : a
+    crash or an abandoned run loads them again (the merges skip known keys),
+    never skips them.
+    """
+    state, loaded = None, {}
+    load_format = config.get("ETL", "LOAD_FORMAT", fallback="json")
+    load_mode = config.get("ETL", "LOAD_MODE", fallback="full")
+    if load_format in preprocessed_copy_queries:
+        load_preprocessed_tables(pool, context, s3,
+                                 {'log_data'  : config.get("ETL", "LOCAL_LOG_DATA"),
+                                  'song_data' : config.get("ETL", "LOCAL_SONG_DATA")},
+                                 config.get("ETL", "PREPROCESS_DIR", fallback="preprocessed"),
+                                 config.get("S3", "PREPROCESSED_PREFIX"),
+                                 output_format=load_format,
+                                 chunks_per_slice=config.getint("ETL", "CHUNKS_PER_SLICE", fallback=1))
+    elif load_mode == "incremental":
+        state = IngestState(config.get("ETL", "STATE_DB", fallback="ingest_state.db"))
+        loaded = load_staging_incremental(pool, context, s3, state, config.get("S3", "MANIFEST_PREFIX"))
+    elif load_mode == "planned":
+        packed_state = IngestState(config.get("ETL", "STATE_DB", fallback="ingest_state.db"))
+        load_staging_planned(pool, context, s3, config.get("S3", "PACKED_PREFIX"),
+                             {feed: config.get("ETL", option)
+                              for feed, option in (('log_data', 'LOG_MANIFEST'), ('song_data', 'SONG_MANIFEST'))
+                              if config.has_option("ETL", option)},
+                             packed_state)
+        packed_state.close()
+    else:
+        load_staging_tables(pool, context)
+    ledger.record(WHOLE_LOAD, 'load')
+    if state:
+        for feed, objects in loaded.items():
+            state.mark_pending(ledger.run_id, feed, objects)
+        state.close()
+
+def commit_ingest_state(config, run_id):
+    """This function marks the files staged by the incremental load of
+    'run_id' as ingested, once the run has merged them
+    """
+    if config.get("ETL", "LOAD_MODE", fallback="full") != "incremental":
+        return
+    state = IngestState(config.get("ETL", "STATE_DB", fallback="ingest_state.db"))
+    print("{} file(s) ingested by run {}".format(state.commit_pending(run_id), run_id))
+    state.close()
+
+def refresh_calendar(pool):
+    """This function extends the calendar_hours lookup to cover the staged
+    events. Only years not generated by an earlier run are added.
+    """
+    with pool.transaction() as cur:
+        time_range = staged_time_range(cur)
+        if time_range:
+            print("calendar_hours : {} row(s) added".format(ensure_calendar(cur, *time_range)))
+
+def plan_dimensions(pool, cache, graph=process_table_graph):
+    """This function checks the staged songs & artists of 'graph' against
+    the local digest cache (dimcache.py). Returns the merge chains to run,
+    where an unchanged dimension has an empty chain and a changed one merges
+    only its changed keys, and the digests to record once the chains commit.
+    """
+    chains = dict(process_table_chains)
+    dimensions = {name: spec for name, spec in cached_dimensions.items() if name in graph}
+    with pool.transaction() as cur:
+        pending = plan_dimension_changes(cur, cache, dimensions, chains, changed_key_chains)
+    skip_derived(chains, cached_derived_chains)
+    return chains, pending
+
+def insert_tables(pool, ledger, context, max_workers=4, chains=process_table_chains, profiles=None, session_settings=None,
+                  graph=process_table_graph):
+    """This function performs the necessary transformations & load targets.
+    Source - stg_events & stg_songs
+    Target - songs, artists, users, time, songplays
+    Load type - designed to do merge, that is load incremental data.
+            For 'users' table alone update of attribute 'level' happens
+    Merge chains are run as a dependency graph (process_table_graph), so
+    independent chains run at the same time, each on its own pooled
+    connection. The NextSong events are refined once into stg_plays, from
+    which users, time & songplays are merged one day of events at a time.
+    Every chain commits once, as a single transaction, together with
+    its checkpoint in the run ledger; chains already checkpointed by an
+    interrupted run are skipped. With 'profiles', every statement runs in
+    its WLM query group & slot count (see profiles.py). 'graph' limits
+    the run to some chains (dependencies left out are assumed done).
+    """
+    timings = run_checkpointed(pool, ledger, context, graph, chains,
+                               partitioned_chains, query_names, max_workers, profiles, session_settings)
+    for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print("{:<16} {:>8.2f}s".format(name, seconds))
+
+def merge_tables(pool, ledger, context, config, graph=process_table_graph, max_workers=4, wlm=True,
+                 dim_cache_db=None):
+    """This function runs the merge chains of 'graph' as every run does :
+        - songs & artists unchanged since the last run are not merged again
+          (see plan_dimensions; DIM_CACHE = false in [ETL] merges them in full),
+          their digests kept in 'dim_cache_db', DIM_CACHE_DB of [ETL] by default
+        - the chains run checkpointed (see insert_tables), in their WLM
+          profiles when 'wlm' is set
+        - with 'wlm', the merged targets whose stats or sort order drifted
+          are ANALYZEd / VACUUMed (see profiles.maintain)
+    """
+    chains, pending, cache = process_table_chains, {}, None
+    if any(name in graph for name in cached_dimensions) and config.getboolean("ETL", "DIM_CACHE", fallback=True):
+        cache = DimensionCache(dim_cache_db or config.get("ETL", "DIM_CACHE_DB", fallback="dim_cache.db"))
+        chains, pending = plan_dimensions(pool, cache, graph)
+    insert_tables(pool, ledger, context, max_workers, chains, query_profiles if wlm else None,
+                  dict(config.items("SESSION")) if config.has_section("SESSION") else {}, graph)
+    if cache:
+        with pool.transaction() as cur:
+            commit_dimension_changes(cur, cache, cached_dimensions, pending)
+        cache.close()
+    if wlm:
+        maintain(pool, *maintenance_targets({name: chains[name] for name in graph}, query_profiles),
+                 analyze_threshold=config.getfloat("ETL", "ANALYZE_THRESHOLD", fallback=10.0),
+                 vacuum_threshold=config.getfloat("ETL", "VACUUM_THRESHOLD", fallback=20.0))
+
+def check_quality(pool, run_id, check_names=None):
+    """This function runs the data-quality checks of quality.py on the
+    target tables, one query per checked table, and records the results
+    for the run. Returns the failed CheckResults.
+    """
+    with pool.transaction() as cur:
+        return report(run_checks(cur, select_checks(check_names), run_id))
+
+
+def finish_run(config, ledger, failed=(), fail=True, ingest=True, close=True):
+    """This function closes a run whose quality results are recorded :
+        - the run is marked finished in the ledger, 'failed' when checks
+          failed, so it is not resumed either way
+        - the files it merged are marked as ingested (unless 'ingest' is False)
+        - RuntimeError is raised on failed checks when 'fail' is set
+    With 'close' False (chains left to merge), the run is left open for a
+    later run to resume, its files pending, and only the last step applies.
+    """
+    if close:
+        ledger.finish(failed=bool(failed))
+        if ingest:
+            commit_ingest_state(config, ledger.run_id)
+    else:
+        print("run {} left open : not every chain is merged yet".format(ledger.run_id))
+    if failed and fail:
+        raise RuntimeError("{} data-quality check(s) failed : {}".format(
+            len(failed), ", ".join(result.name for result in failed)))
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    redshift = boto3.client('redshift',
+                   region_name="us-west-2",
+                   aws_access_key_id=config.get('AWS','KEY'),
+                   aws_secret_access_key=config.get('AWS','SECRET')
+                   )
+
+    #This step is to extract the ARN & ENDPOINT information to be used in further steps.
+    myClusterProps = redshift.describe_clusters(ClusterIdentifier=config.get("CLUSTER","CLS_IDENTIFIER"))['Clusters'][0]        
+    aws_arn, aws_clstr = myClusterProps['IamRoles'][0]['IamRoleArn'], myClusterProps['Endpoint']['Address']
+    
+    print(aws_arn)
+    
+    #Every statement is timed & recorded (name, rows, query id) into a metrics file
+    metrics = RunMetrics('etl', config.get("ETL", "METRICS_DIR", fallback="metrics"))
+    query_ids = config.getboolean("ETL", "QUERY_IDS", fallback=True)
+
+    #COPY statements are rendered with the S3 locations & the cluster's role ARN
+    context = RunContext(config, role_arn=aws_arn)
+
+    #Create a connection pool for the REDSHIFT cluster, shared by every step
+    pool = pool_from_config(config, aws_clstr,
+                            wrap_cursor=lambda cur: InstrumentedCursor(ContextCursor(cur, context), metrics, query_names, query_ids))
+    
+    s3 = boto3.client('s3',
+                   region_name="us-west-2",
+                   aws_access_key_id=config.get('AWS','KEY'),
+                   aws_secret_access_key=config.get('AWS','SECRET')
+                   )
+
+    #resume the last run if it did not complete (RESUME = false always starts afresh)
+    ledger = RunLedger(pool, resume=config.getboolean("ETL", "RESUME", fallback=True))
+    ledger.start()
+
+    #load JSON data into staging tables in redshift (LOAD_FORMAT / LOAD_MODE, see load_from_config)
+    #the events & songs COPYs always run at the same time, on separate sessions
+    #a resumed run keeps the staging tables its first attempt loaded
+    if ledger.done(WHOLE_LOAD, 'load'):
+        print("staging tables already loaded by run {}".format(ledger.run_id))
+    else:
+        load_from_config(pool, context, s3, config, ledger)
+
+    #make sure the time dimension lookup covers the staged events
+    refresh_calendar(pool)
+
+    #process staging table data and perform necesary transformations and load targets.
+    #independent merge chains run in parallel, each on its own pooled connection.
+    #songs & artists unchanged since the last run are not merged again
+    #(DIM_CACHE = false in [ETL] merges them in full every run)
+    #the merged targets whose stats or sort order drifted are ANALYZEd / VACUUM SORT ONLY
+    #WLM = false in [ETL] runs every statement in the default queue, without maintenance
+    merge_tables(pool, ledger, context, config, max_workers=config.getint("ETL", "MAX_WORKERS", fallback=4),
+                 wlm=config.getboolean("ETL", "WLM", fallback=True))
+
+    #validate the targets; CHECKS in [QUALITY] selects checks (default all)
+    failed = check_quality(pool, ledger.run_id,
+                           [name.strip() for name in config.get("QUALITY", "CHECKS", fallback="").split(",") if name.strip()])
+
+    #the run is closed (failed on failed checks) before FAIL = true raises;
+    #FAIL = false only reports failures
+    finish_run(config, ledger, failed, config.getboolean("QUALITY", "FAIL", fallback=True))
+
+    pool.closeall()
+
+    metrics.print_summary()
+    print("metrics written to {}".format(metrics.write()))
+    print("etl.py process completed successfully ! Well done !!")
+
+if __name__ == "__main__":
+    main()
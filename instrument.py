@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+
+def statement_names(namespace):
+    """This function maps every SQL statement string of a module namespace
+    (e.g. vars(sql_queries)) to the variable name it is defined under
+    """
+    names = {}
+    for name, value in namespace.items():
+        if isinstance(value, str) and not name.startswith('_') and name.islower():
+            names.setdefault(value, name)
+    return names
+
+
+class RunMetrics:
+    """Collects one record per executed statement for a run and writes them
+    as a single JSON file, metrics_dir/<script>-<run id>.json
+    """
+
+    def __init__(self, script, metrics_dir='metrics'):
+        self.script = script
+        self.run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self.path = os.path.join(metrics_dir, "{}-{}.json".format(script, self.run_id))
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, **fields):
+        with self._lock:
+            self.records.append(fields)
+
+    def summary(self):
+        """Returns per statement name : executions, total seconds, total rows,
+        sorted by total time, longest first
+        """
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                total = totals.setdefault(record['name'], {'name': record['name'], 'executions': 0,
+                                                           'seconds': 0.0, 'rows': 0})
+                total['executions'] += 1
+                total['seconds'] += record['seconds']
+                total['rows'] += max(record['rowcount'], 0)
+        return sorted(totals.values(), key=lambda total: -total['seconds'])
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock:
+            records = list(self.records)
+        with open(self.path, 'w') as f:
+            json.dump({'script'     : self.script,
+                       'run_id'     : self.run_id,
+                       'statements' : records,
+                       'summary'    : self.summary()}, f, indent=2, default=str)
+        return self.path
+
+    def print_summary(self, top=10):
+        for total in self.summary()[:top]:
+            print("{:<32} {:>4}x {:>10.2f}s {:>12} rows".format(total['name'], total['executions'],
+                                                               total['seconds'], total['rows']))
+
+
+class InstrumentedCursor:
+    """Wraps a psycopg2 cursor so every execute() is recorded in RunMetrics
+    with the statement name from sql_queries.py, wall time, rowcount and,
+    when 'query_ids' is set (Redshift), the query id from pg_last_query_id().
+    Everything else is delegated to the wrapped cursor.
+    """
+
+    def __init__(self, cursor, metrics, names, query_ids=True):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._names = names
+        self._query_ids = query_ids
+        self.rowcount = -1
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def execute(self, query, vars=None, name=None):
+        # statements built at run time are labelled by their first words
+        name = name or self._names.get(query) or ' '.join(str(query).split()[:3])
+        started_at = datetime.now(timezone.utc).isoformat()
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(query, vars)
+        except Exception as e:
+            self._metrics.record(name=name, started_at=started_at, seconds=time.perf_counter() - start,
+                                 rowcount=-1, query_id=None, thread=threading.current_thread().name,
+                                 error=str(e).strip())
+            raise
+        seconds = time.perf_counter() - start
+        rowcount = self.rowcount = self._cursor.rowcount
+        query_id = None
+        if self._query_ids and self._cursor.description is None:
+            # statements returning rows keep their result set unread
+            self._cursor.execute("select pg_last_query_id()")
+            query_id = self._cursor.fetchone()[0]
+        self._metrics.record(name=name, started_at=started_at, seconds=seconds, rowcount=rowcount,
+                             query_id=query_id, thread=threading.current_thread().name)
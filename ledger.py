@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta, timezone
+
+from profiles import Profile, ProfileSwitcher
+from run_context import render
+from scheduler import run_dag
+
+
+# Checkpointed etl runs : every completed step is recorded in etl_run_ledger
+# in the same transaction as the step itself, so a run that fails part way
+# is resumed by the next one from the first step not recorded.
+
+WHOLE_LOAD = '-'
+
+
+def staged_partitions(cur):
+    """This function returns the days of the refined plays (stg_plays), in
+    order; run_checkpointed() reads them once the refinement chain has run
+    """
+    cur.execute("select distinct date_trunc('day', start_time) from stg_plays order by 1")
+    return [row[0].date() for row in cur.fetchall()]
+
+
+def partition_values(day):
+    """Returns the RunContext values of the partition of one day of events"""
+    return {'partition_start' : day.isoformat(),
+            'partition_end'   : (day + timedelta(days=1)).isoformat()}
+
+
+class RunLedger:
+    """Steps completed by the current etl run, backed by etl_run_ledger.
+    start() resumes the latest run if it did not finish (unless resume is
+    False), otherwise begins a new one; finish() marks the run complete or
+    failed.
+    """
+
+    def __init__(self, pool, resume=True):
+        self._pool = pool
+        self._resume = resume
+        self._done = set()
+        self.run_id = None
+        self.resumed = False
+
+    @staticmethod
+    def _unfinished(cur):
+        cur.execute("""select run_id, sum(case when status in ('done', 'failed') then 1 else 0 end)
+                         from etl_run_ledger
+                        where step = 'run'
+                        group by run_id
+                        order by max(recorded_at) desc
+                        limit 1""")
+        latest = cur.fetchone()
+        return latest[0] if latest and latest[1] == 0 else None
+
+    def unfinished(self):
+        """Returns the id of the latest run if it did not finish, else None"""
+        with self._pool.transaction() as cur:
+            return self._unfinished(cur)
+
+    def start(self):
+        with self._pool.transaction() as cur:
+            latest = self._unfinished(cur)
+            if self._resume and latest:
+                self.run_id, self.resumed = latest, True
+                cur.execute("select partition_key, step from etl_run_ledger where run_id = %s and status = 'done'",
+                            (self.run_id,))
+                self._done = set(cur.fetchall())
+            else:
+                self.run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+                self.checkpoint(cur, WHOLE_LOAD, 'run', 'started')
+        print("{} run {} ({} step(s) already done)".format("Resuming" if self.resumed else "Starting",
+                                                          self.run_id, len(self._done)))
+        return self.run_id
+
+    def done(self, partition, step):
+        return (partition, step) in self._done
+
+    def checkpoint(self, cur, partition, step, status='done'):
+        """This function records a step on 'cur', i.e. in the transaction of
+        the step itself
+        """
+        cur.execute("""INSERT INTO etl_run_ledger (run_id, partition_key, step, status, recorded_at)
+                       VALUES (%s, %s, %s, %s, %s)""",
+                    (self.run_id, partition, step, status, datetime.now(timezone.utc).replace(tzinfo=None)))
+        if status == 'done':
+            self._done.add((partition, step))
+
+    def complete(self, graph, partitioned):
+        """This function tells whether the run has loaded the staging tables
+        and checkpointed every chain of 'graph', the 'partitioned' ones for
+        every day of refined plays
+        """
+        with self._pool.transaction() as cur:
+            days = staged_partitions(cur)
+        return self.done(WHOLE_LOAD, 'load') and all(
+            all(self.done(day.isoformat(), name) for day in days) if name in partitioned
+            else self.done(WHOLE_LOAD, name)
+            for name in graph)
+
+    def record(self, partition, step):
+        """This function records a step that ran in transactions of its own"""
+        with self._pool.transaction() as cur:
+            self.checkpoint(cur, partition, step)
+
+    def finish(self, failed=False):
+        """This function marks the run complete, 'failed' when it ended on
+        failed data-quality checks; either way it is not resumed
+        """
+        with self._pool.transaction() as cur:
+            self.checkpoint(cur, WHOLE_LOAD, 'run', 'failed' if failed else 'done')
+
+
+def _subgraph(graph, nodes):
+    return {node: [dep for dep in deps if dep in nodes] for node, deps in graph.items() if node in nodes}
+
+
+def run_checkpointed(pool, ledger, context, graph, chains, partitioned, names, max_workers=4,
+                     profiles=None, session_settings=None):
+    """This function runs the merge chains of 'graph', skipping the chains
+    the ledger already has :
+        (1) chains not depending on a partitioned chain, once for the load
+        (2) the 'partitioned' chains once per day of staged events, in day
+            order, each partition rendered with its partition_start/end
+        (3) the remaining chains, once for the load
+    Every chain runs in one transaction that also records its checkpoint.
+    With 'profiles' (statement -> profiles.Profile), each statement runs
+    with its WLM query group & slot count, Profile() defaults otherwise,
+    and the session values are restored at the end of the chain.
+    Statements are rendered here and labelled with their catalog name, so
+    the pool cursors must accept execute(..., name=) (InstrumentedCursor).
+    Returns dict of chain (chain@day for partitioned ones) -> seconds.
+    """
+    partitioned = set(partitioned)
+    after = set()
+    for node in [node for node in graph if node not in partitioned]:
+        pending = list(graph[node])
+        while pending:
+            dep = pending.pop()
+            if dep in partitioned or dep in after:
+                after.add(node)
+                break
+            pending.extend(graph[dep])
+    before = set(graph) - partitioned - after
+
+    def chain_runner(partition, chain_context):
+        def run_chain(name):
+            if ledger.done(partition, name):
+                print("{} ({}) already done".format(name, partition))
+                return
+            with pool.transaction() as cur:
+                switcher = ProfileSwitcher(cur, session_settings) if profiles is not None else None
+                for query in chains[name]:
+                    if switcher:
+                        switcher.apply(profiles.get(query) or Profile())
+                    cur.execute(render(query, chain_context), name=names.get(query))
+                if switcher:
+                    switcher.restore()
+                ledger.checkpoint(cur, partition, name)
+        return run_chain
+
+    timings = dict(run_dag(_subgraph(graph, before), chain_runner(WHOLE_LOAD, context), max_workers))
+    with pool.transaction() as cur:
+        days = staged_partitions(cur)
+    for day in days:
+        partition = day.isoformat()
+        part_timings = run_dag(_subgraph(graph, partitioned),
+                               chain_runner(partition, context.with_values(**partition_values(day))),
+                               max_workers)
+        timings.update(("{}@{}".format(name, partition), seconds) for name, seconds in part_timings.items())
+    timings.update(run_dag(_subgraph(graph, after), chain_runner(WHOLE_LOAD, context), max_workers))
+    return timings
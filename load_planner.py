@@ -0,0 +1,149 @@
+import gzip
+import heapq
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from manifest import build_manifest, list_objects, split_s3_url, write_manifest
+
+
+# Slice-aware COPY planning : the source files of a feed are packed into as
+# many gzip files as the cluster has slices, balanced by size, so every slice
+# loads about the same number of bytes whatever the source layout (thousands
+# of tiny song files, a few large log days...). JSON COPY accepts several
+# objects per file, so packing is a plain concatenation. With an ingest
+# state, packed files are reused from run to run and only the source files
+# added or changed since are downloaded and packed.
+
+def balanced_buckets(objects, num_buckets):
+    """This function splits objects (dicts with 'size') into at most
+    'num_buckets' groups of near-equal total size : largest object first,
+    each into the group with the smallest total so far. Empty groups are
+    left out. Returns a list of lists of objects.
+    """
+    heap = [(0, n, []) for n in range(num_buckets)]
+    for obj in sorted(objects, key=lambda obj: -obj['size']):
+        total, n, bucket = heapq.heappop(heap)
+        bucket.append(obj)
+        heapq.heappush(heap, (total + obj['size'], n, bucket))
+    return [bucket for _, _, bucket in sorted(heap, key=lambda item: item[1]) if bucket]
+
+
+def read_manifest_file(path):
+    """This function reads a local Redshift COPY manifest and returns its
+    entries as objects like list_objects() does ('key', 'etag', 'size',
+    'url'). A manifest has no etag : the size stands in for it, so a file
+    rewritten with another size is packed again.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    objects = []
+    for entry in manifest['entries']:
+        _, key = split_s3_url(entry['url'])
+        size = entry.get('meta', {}).get('content_length', 0)
+        objects.append({'key'  : key,
+                        'etag' : "size:{}".format(size),
+                        'url'  : entry['url'],
+                        'size' : size})
+    return objects
+
+
+def plan_packing(objects, packed, num_slices, files_per_slice=4):
+    """This function compares the source files of a feed with the packed
+    files of the previous runs (see IngestState.packed) and returns
+    (packed files kept, as {packed key : size}, packed keys to delete,
+    source objects to pack). A packed file is kept while every source file
+    it holds is unchanged; the sources of any other one are packed again
+    with the new files. When more than 'files_per_slice' files per slice
+    would be loaded, everything is packed again into one file per slice.
+    """
+    current = {obj['key']: obj for obj in objects}
+    all_packed = {packed_key: size for _, packed_key, size in packed.values()}
+    stale = {packed_key for key, (etag, packed_key, _) in packed.items()
+             if key not in current or current[key]['etag'] != etag}
+    kept = {packed_key: size for packed_key, size in all_packed.items() if packed_key not in stale}
+    to_pack = [obj for obj in objects if obj['key'] not in packed or packed[obj['key']][1] in stale]
+    new_files = min(num_slices, len(to_pack))
+    if len(kept) + new_files > num_slices * files_per_slice:
+        return {}, set(all_packed), list(objects)
+    return kept, stale, to_pack
+
+
+def pack_bucket(s3, objects, source_bucket, dest_url):
+    """This function streams the objects of one bucket, one after the other,
+    into a single gzip file uploaded to 'dest_url'. Returns its size.
+    """
+    bucket, key = split_s3_url(dest_url)
+    with tempfile.TemporaryFile() as spool:
+        with gzip.GzipFile(fileobj=spool, mode='wb') as packed:
+            for obj in objects:
+                object_bucket = split_s3_url(obj['url'])[0] if 'url' in obj else source_bucket
+                body = s3.get_object(Bucket=object_bucket, Key=obj['key'])['Body'].read()
+                packed.write(body)
+                if not body.endswith(b'\n'):
+                    packed.write(b'\n')
+        size = spool.tell()
+        spool.seek(0)
+        s3.upload_fileobj(spool, bucket, key)
+    return size
+
+
+def _delete_objects(s3, bucket, keys):
+    keys = list(keys)
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+
+
+def plan_feed(s3, source_url, num_slices, packed_prefix, manifest_path=None, max_workers=8, state=None, feed=None):
+    """This function packs the source files of one feed for a balanced COPY.
+        source_url    - S3 prefix listed when no manifest_path is given
+        manifest_path - optional local COPY manifest listing the source files
+        packed_prefix - S3 prefix receiving the packed .json.gz files and the
+                        'packed.manifest' COPY manifest
+        state, feed   - optional IngestState (manifest.py) remembering which
+                        packed file holds each source file of 'feed' : only
+                        new or changed source files are downloaded and
+                        packed, into new files added to the ones kept (see
+                        plan_packing)
+    Without 'state', files packed by an earlier run are deleted and every
+    source file is packed again. Returns the manifest url, listing every
+    packed file of the feed.
+    """
+    objects = read_manifest_file(manifest_path) if manifest_path else list_objects(s3, source_url)
+    source_bucket = split_s3_url(source_url)[0]
+    dest_bucket, prefix = split_s3_url(packed_prefix.rstrip('/'))
+    existing = {obj['key'] for obj in list_objects(s3, "s3://{}/{}/".format(dest_bucket, prefix))}
+    if state is None:
+        kept, to_pack = {}, objects
+        _delete_objects(s3, dest_bucket, existing)
+    else:
+        # a packed file deleted behind the state's back is packed again
+        packed = state.packed(feed)
+        missing = {packed_key for _, packed_key, _ in packed.values() if packed_key not in existing}
+        kept, stale, to_pack = plan_packing(objects, {key: entry for key, entry in packed.items()
+                                                      if entry[1] not in missing}, num_slices)
+        stale |= missing
+
+    # new files never overwrite kept ones : each batch has its own name
+    batch = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    buckets = balanced_buckets(to_pack, num_slices)
+    urls = ["s3://{}/{}/{}-{:04d}.json.gz".format(dest_bucket, prefix, batch, n) for n in range(len(buckets))]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sizes = list(executor.map(lambda args: pack_bucket(s3, args[0], source_bucket, args[1]), zip(buckets, urls)))
+    print("{} : {} file(s), {} new or changed ({} bytes) packed into {} file(s) of {}-{} bytes, {} packed file(s) kept".format(
+        source_url, len(objects), len(to_pack), sum(obj['size'] for obj in to_pack), len(urls),
+        min(sizes, default=0), max(sizes, default=0), len(kept)))
+
+    files = dict(kept)
+    files.update({split_s3_url(url)[1]: size for url, size in zip(urls, sizes)})
+    manifest_url = "s3://{}/{}/packed.manifest".format(dest_bucket, prefix)
+    write_manifest(s3, manifest_url, build_manifest(dest_bucket, [{'key': key, 'size': size}
+                                                                  for key, size in sorted(files.items())]))
+    if state is not None:
+        # the state follows the manifest just written; stale files go last
+        state.unpack(feed, stale)
+        for bucket, url, size in zip(buckets, urls, sizes):
+            state.mark_packed(feed, split_s3_url(url)[1], size, bucket)
+        _delete_objects(s3, dest_bucket, stale)
+    return manifest_url
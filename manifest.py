@@ -0,0 +1,158 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+def split_s3_url(url):
+    """This function splits 's3://bucket/some/prefix' into ('bucket', 'some/prefix')"""
+    if not url.startswith("s3://"):
+        raise ValueError("not an s3 url : {}".format(url))
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def list_objects(s3, url):
+    """This function lists every object under an S3 prefix.
+    Returns a list of dicts with keys 'key', 'etag' and 'size'.
+    Any client exposing the boto3 'list_objects_v2' paginator can be used,
+    so a local stand-in listing works the same way as S3.
+    """
+    bucket, prefix = split_s3_url(url)
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].endswith('/'):
+                continue
+            objects.append({'key'  : item['Key'],
+                            'etag' : item['ETag'].strip('"'),
+                            'size' : item['Size']})
+    return objects
+
+
+class IngestState:
+    """Local sqlite store of the source files already loaded per feed.
+    A file is considered loaded when the same key was recorded with the
+    same etag; a file rewritten in place gets a new etag and is reloaded.
+    Files staged by an etl run are kept pending under its run id until the
+    run ends (commit_pending); pending files of a run abandoned part way
+    are planned again by the next run. The packed file holding each source
+    file of a planned load (load_planner.py) is tracked as well.
+    """
+
+    def __init__(self, path='ingest_state.db'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS ingested_files
+                                       (feed      text NOT NULL,
+                                        key       text NOT NULL,
+                                        etag      text NOT NULL,
+                                        size      integer NOT NULL,
+                                        loaded_at text NOT NULL,
+                                        PRIMARY KEY (feed, key))""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS pending_files
+                                       (run_id    text NOT NULL,
+                                        feed      text NOT NULL,
+                                        key       text NOT NULL,
+                                        etag      text NOT NULL,
+                                        size      integer NOT NULL,
+                                        PRIMARY KEY (run_id, feed, key))""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS packed_files
+                                       (feed        text NOT NULL,
+                                        key         text NOT NULL,
+                                        etag        text NOT NULL,
+                                        packed_key  text NOT NULL,
+                                        packed_size integer NOT NULL,
+                                        PRIMARY KEY (feed, key))""")
+
+    def loaded(self, feed):
+        """Returns dict of key -> etag for every file recorded for 'feed'"""
+        with self._lock:
+            rows = self._conn.execute("select key, etag from ingested_files where feed = ?", (feed,))
+            return dict(rows.fetchall())
+
+    def mark_loaded(self, feed, objects):
+        """Records 'objects' (as returned by list_objects) as loaded for 'feed'"""
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        with self._lock, self._conn:
+            self._conn.executemany("""INSERT OR REPLACE INTO ingested_files
+                                          (feed, key, etag, size, loaded_at)
+                                      VALUES (?, ?, ?, ?, ?)""",
+                                   [(feed, obj['key'], obj['etag'], obj['size'], loaded_at)
+                                    for obj in objects])
+
+    def mark_pending(self, run_id, feed, objects):
+        """Records 'objects' as staged by etl run 'run_id'; pending files of
+        any other run are dropped, their run having been abandoned
+        """
+        with self._lock, self._conn:
+            self._conn.execute("delete from pending_files where run_id <> ?", (run_id,))
+            self._conn.executemany("""INSERT OR REPLACE INTO pending_files (run_id, feed, key, etag, size)
+                                      VALUES (?, ?, ?, ?, ?)""",
+                                   [(run_id, feed, obj['key'], obj['etag'], obj['size']) for obj in objects])
+
+    def commit_pending(self, run_id):
+        """Marks the files staged by 'run_id' as loaded, once the run ended.
+        Returns the number of files.
+        """
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        with self._lock, self._conn:
+            rows = self._conn.execute("select feed, key, etag, size from pending_files where run_id = ?",
+                                      (run_id,)).fetchall()
+            self._conn.executemany("""INSERT OR REPLACE INTO ingested_files
+                                          (feed, key, etag, size, loaded_at)
+                                      VALUES (?, ?, ?, ?, ?)""",
+                                   [row + (loaded_at,) for row in rows])
+            self._conn.execute("delete from pending_files where run_id = ?", (run_id,))
+            return len(rows)
+
+    def packed(self, feed):
+        """Returns dict of source key -> (etag, packed key, packed size) for
+        every source file of 'feed' packed by load_planner.py
+        """
+        with self._lock:
+            rows = self._conn.execute("select key, etag, packed_key, packed_size from packed_files where feed = ?",
+                                      (feed,))
+            return {key: (etag, packed_key, packed_size) for key, etag, packed_key, packed_size in rows.fetchall()}
+
+    def mark_packed(self, feed, packed_key, packed_size, objects):
+        """Records 'objects' as packed into the file 'packed_key'"""
+        with self._lock, self._conn:
+            self._conn.executemany("""INSERT OR REPLACE INTO packed_files (feed, key, etag, packed_key, packed_size)
+                                      VALUES (?, ?, ?, ?, ?)""",
+                                   [(feed, obj['key'], obj['etag'], packed_key, packed_size) for obj in objects])
+
+    def unpack(self, feed, packed_keys):
+        """Forgets the packed files 'packed_keys' of 'feed' and their sources"""
+        with self._lock, self._conn:
+            self._conn.executemany("delete from packed_files where feed = ? and packed_key = ?",
+                                   [(feed, packed_key) for packed_key in packed_keys])
+
+    def close(self):
+        self._conn.close()
+
+
+def plan_incremental(feed, objects, state):
+    """This function returns the objects of a listing that are new, or
+    changed since they were loaded, in key order
+    """
+    loaded = state.loaded(feed)
+    return sorted((obj for obj in objects if loaded.get(obj['key']) != obj['etag']),
+                  key=lambda obj: obj['key'])
+
+
+def build_manifest(bucket, objects):
+    """This function builds a Redshift COPY manifest for 'objects'.
+    Entries are mandatory, so COPY fails if a planned file disappeared.
+    """
+    return {'entries': [{'url'       : 's3://{}/{}'.format(bucket, obj['key']),
+                         'mandatory' : True,
+                         'meta'      : {'content_length': obj['size']}}
+                        for obj in objects]}
+
+
+def write_manifest(s3, url, manifest):
+    """This function uploads a manifest to the S3 location 'url'"""
+    bucket, key = split_s3_url(url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
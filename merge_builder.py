@@ -0,0 +1,107 @@
+class MergeSpec:
+    """Declarative description of how one target table is merged from staging.
+        target        - target table name
+        source        - SELECT producing the incoming rows, one column per
+                        entry of 'columns', in the same order
+        columns       - target column names
+        keys          - business key columns, subset of 'columns'
+        update        - columns overwritten when the key already exists;
+                        when empty, existing rows are left untouched
+        latest_by     - ORDER BY expression, or list of them, ranking the
+                        incoming rows of one key; only the highest row (each
+                        expression descending, nulls last) is kept. Defaults
+                        to every non-key column, so the row kept never
+                        depends on the order rows were staged in.
+        insert_columns- columns to insert, defaults to 'columns' (e.g. to
+                        leave out an IDENTITY column)
+        target_filter - optional predicate on the target rows (alias t) that
+                        can match a staged key, e.g. the start_time range of
+                        the partition; bounds the scan of the target by the
+                        insert of new keys (not allowed with 'update')
+    """
+
+    def __init__(self, target, source, columns, keys, update=(), latest_by=None, insert_columns=None,
+                 target_filter=None):
+        self.target = target
+        self.source = source
+        self.columns = list(columns)
+        self.keys = list(keys)
+        self.update = list(update)
+        self.latest_by = [latest_by] if isinstance(latest_by, str) else list(latest_by or ())
+        self.insert_columns = list(insert_columns or columns)
+        self.target_filter = target_filter
+        if target_filter and self.update:
+            raise ValueError("{} : target_filter only applies to insert-only merges".format(target))
+        for column in self.keys + self.update + self.insert_columns:
+            if column not in self.columns:
+                raise ValueError("{} : unknown column '{}'".format(target, column))
+
+    @property
+    def work_table(self):
+        return "{}_stg".format(self.target)
+
+
+def ranked_source(spec):
+    """This function returns the SELECT of the incoming rows of 'spec' kept
+    by the merge : one row per business key, the highest by latest_by
+    """
+    order = spec.latest_by or [column for column in spec.columns if column not in spec.keys] or spec.keys
+    return """select {cols}
+                  from (select src.*,
+                               row_number() over (partition by {keys}
+                                                  order by {order}) as merge_rn
+                          from ({source}) src) ranked
+                 where merge_rn = 1""".format(cols=", ".join(spec.columns),
+                                              keys=", ".join(spec.keys),
+                                              order=", ".join("{} desc nulls last".format(expression)
+                                                              for expression in order),
+                                              source=spec.source)
+
+
+def _work_table_create(spec):
+    # one row per business key, whatever the source holds : the insert of
+    # new keys must never insert a key twice
+    return "CREATE TEMP TABLE {} AS {}".format(spec.work_table, ranked_source(spec))
+
+
+def _key_match(spec, target_alias, source_alias):
+    return " and ".join("{t}.{c} = {s}.{c}".format(t=target_alias, s=source_alias, c=key)
+                        for key in spec.keys)
+
+
+def _merge(spec):
+    if spec.update:
+        return """MERGE INTO {target}
+                  USING {work} s
+                     ON {match}
+                  WHEN MATCHED THEN UPDATE SET {sets}
+                  WHEN NOT MATCHED THEN INSERT ({cols}) VALUES ({vals})""".format(
+            target=spec.target,
+            work=spec.work_table,
+            match=_key_match(spec, spec.target, "s"),
+            sets=", ".join("{c} = s.{c}".format(c=col) for col in spec.update),
+            cols=", ".join(spec.insert_columns),
+            vals=", ".join("s.{}".format(col) for col in spec.insert_columns))
+    return """INSERT INTO {target} ({cols})
+              SELECT {vals}
+                FROM {work} s
+               WHERE NOT EXISTS (select 1 from {target} t where {match})""".format(
+        target=spec.target,
+        work=spec.work_table,
+        cols=", ".join(spec.insert_columns),
+        vals=", ".join("s.{}".format(col) for col in spec.insert_columns),
+        match=_key_match(spec, "t", "s") + (" and {}".format(spec.target_filter) if spec.target_filter else ""))
+
+
+def merge_statements(spec):
+    """This function returns the statements merging one target table:
+        (1) stage one incoming row per business key (see MergeSpec.latest_by)
+            into a session temp table
+        (2) a single MERGE (update + insert) when the spec has update columns,
+            otherwise a single insert of the keys not present yet
+        (3) drop the temp table
+    Run them in one transaction on one connection.
+    """
+    return [_work_table_create(spec),
+            _merge(spec),
+            "DROP TABLE IF EXISTS {}".format(spec.work_table)]
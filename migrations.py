@@ -0,0 +1,344 @@
+import hashlib
+import re
+from datetime import datetime, timezone
+
+from aggregates import rollups
+from schema import Column, TableSpec, create_table_sql
+
+
+# Non-destructive schema migration : the table specs in schema.py are the
+# desired state, the database catalog the current one. Only the difference
+# is applied, and every applied version is recorded in schema_versions.
+
+schema_versions_create = ("""CREATE TABLE IF NOT EXISTS schema_versions
+                                    (version    varchar(16) NOT NULL,
+                                     applied_at timestamp NOT NULL,
+                                     statements varchar(65535)
+                                    )
+""")
+
+# tables only holding the rows of the current load : rebuilt empty
+STAGING_PREFIX = 'stg_'
+
+# table -> views reading it (objects with drop_sql() / create_sql()). A deep
+# copy drops the old table and a column type change is refused while a view
+# depends on it, so these views are dropped before and created again after.
+DEPENDENT_VIEWS = {
+    'songplays' : rollups,
+}
+
+# pg_class.reldiststyle -> DISTSTYLE; AUTO(ALL / EVEN / KEY) all read as AUTO
+DISTSTYLES = {0: 'EVEN', 1: 'KEY', 8: 'ALL', 9: 'AUTO', 10: 'AUTO', 11: 'AUTO'}
+
+TYPE_ALIASES = {
+    'integer'                     : 'int',
+    'int4'                        : 'int',
+    'int2'                        : 'smallint',
+    'int8'                        : 'bigint',
+    'character varying'           : 'varchar',
+    'character'                   : 'char',
+    'bpchar'                      : 'char',
+    'decimal'                     : 'numeric',
+    'timestamp without time zone' : 'timestamp',
+    'double precision'            : 'float8',
+    'boolean'                     : 'bool',
+}
+
+
+class MigrationStep:
+    """One change to apply.
+        transactional - False for statements Redshift refuses to run inside
+                        a transaction block (ALTER COLUMN TYPE, ALTER DISTKEY...)
+    """
+
+    def __init__(self, description, statements, transactional=True):
+        self.description = description
+        self.statements = list(statements)
+        self.transactional = transactional
+
+    def __repr__(self):
+        return "MigrationStep({!r})".format(self.description)
+
+
+def normalize_type(type_name, length=None, precision=None, scale=None):
+    """This function returns a canonical spelling of a column type, e.g.
+    ('character varying', 256) -> 'varchar(256)', 'integer' -> 'int'
+    """
+    match = re.match(r'^\s*([a-z ]+?)\s*(\(([^)]*)\))?\s*$', type_name.lower())
+    base, args = match.group(1), match.group(3)
+    base = TYPE_ALIASES.get(base, base)
+    if args is None:
+        if base in ('varchar', 'char') and length:
+            args = str(length)
+        elif base == 'numeric' and precision:
+            args = "{},{}".format(precision, scale or 0)
+    if args:
+        args = ",".join(arg.strip() for arg in args.split(','))
+        if base == 'numeric' and ',' not in args:
+            args += ',0'
+        return "{}({})".format(base, args)
+    return base
+
+
+def schema_version(specs):
+    """This function returns a short hash identifying the desired schema"""
+    ddl = "\n".join(create_table_sql(spec) for spec in specs)
+    return hashlib.sha256(ddl.encode('utf-8')).hexdigest()[:16]
+
+
+def read_catalog(cur, table_names, schema='public'):
+    """This function reads the current columns of the given tables from
+    information_schema. Returns dict of table -> ordered dict column -> type.
+    """
+    cur.execute("""select table_name, column_name, data_type, character_maximum_length,
+                          numeric_precision, numeric_scale
+                     from information_schema.columns
+                    where table_schema = %s and table_name in %s
+                    order by table_name, ordinal_position""", (schema, tuple(table_names)))
+    catalog = {}
+    for table, column, data_type, length, precision, scale in cur.fetchall():
+        catalog.setdefault(table, {})[column] = normalize_type(data_type, length, precision, scale)
+    return catalog
+
+
+def read_physical_design(cur, table_names):
+    """This function reads distribution style & keys and sort keys from
+    pg_class and pg_table_def (Redshift only). Returns dict of
+    table -> (diststyle, distkey column, [sortkey columns]).
+    """
+    cur.execute("""select relname, reldiststyle
+                     from pg_class
+                    where relkind = 'r' and relname in %s""", (tuple(table_names),))
+    diststyles = {table: DISTSTYLES.get(code, 'AUTO') for table, code in cur.fetchall()}
+    cur.execute("""select tablename, "column", distkey, sortkey
+                     from pg_table_def
+                    where tablename in %s""", (tuple(table_names),))
+    design = {}
+    for table, column, is_distkey, sortkey in cur.fetchall():
+        distkey, sortkeys = design.setdefault(table, [None, {}])
+        if is_distkey:
+            design[table][0] = column
+        if sortkey and sortkey > 0:
+            sortkeys[sortkey] = column
+    return {table: (diststyles.get(table), distkey, [sortkeys[n] for n in sorted(sortkeys)])
+            for table, (distkey, sortkeys) in design.items()}
+
+
+def _varchar_length(type_name):
+    match = re.match(r'^varchar\((\d+)\)$', type_name)
+    return int(match.group(1)) if match else None
+
+
+def _identity(column):
+    """(seed, step) of an IDENTITY column, None for any other column"""
+    match = re.match(r'^(?:GENERATED BY DEFAULT AS )?IDENTITY\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)$',
+                     (column.extra or '').strip(), re.I)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def narrowed_columns(spec, current_columns):
+    """This function returns the varchar columns of a table the spec makes
+    shorter, as a list of (column name, desired length)
+    """
+    narrowed = []
+    for column in spec.columns:
+        current = _varchar_length(current_columns.get(column.name, ''))
+        desired = _varchar_length(normalize_type(column.type))
+        if current and desired and desired < current:
+            narrowed.append((column.name, desired))
+    return narrowed
+
+
+def read_table_stats(cur, specs, catalog):
+    """This function reads what the deep copy of a table has to preserve :
+    the longest value (in bytes) of every varchar column the spec makes
+    shorter, and the highest value of every IDENTITY column. Only tables a
+    deep copy rebuilds are read. Returns dict of table -> {column : value}.
+    """
+    stats = {}
+    for spec in specs:
+        current = catalog.get(spec.name)
+        if current is None or spec.name.startswith(STAGING_PREFIX) or not _column_changes(spec, current)[0]:
+            continue
+        expressions = {name: "max(octet_length({}))".format(name) for name, _ in narrowed_columns(spec, current)}
+        expressions.update({column.name: "max({})".format(column.name) for column in spec.columns
+                            if _identity(column) and column.name in current})
+        if expressions:
+            cur.execute("select {} from {}".format(", ".join(expressions.values()), spec.name))
+            stats[spec.name] = dict(zip(expressions, cur.fetchone()))
+    return stats
+
+
+def _is_widening(current, desired):
+    """True when only the length of a varchar grows"""
+    current_length, desired_length = _varchar_length(current), _varchar_length(desired)
+    return bool(current_length and desired_length and desired_length > current_length)
+
+
+def deep_copy(spec, current_columns, identity_max=None):
+    """This function returns the statements rebuilding a table with its
+    desired definition and copying the rows over, casting columns whose type
+    changed. New columns start NULL and columns missing from the spec are not
+    carried over. IDENTITY values are copied as they are : the column is
+    rebuilt GENERATED BY DEFAULT, seeded past 'identity_max' (column -> highest
+    current value), so later rows never reuse an id.
+    """
+    old = "{}__old".format(spec.name)
+    identity_max = identity_max or {}
+    columns = []
+    for column in spec.columns:
+        identity = _identity(column)
+        if identity and column.name in current_columns:
+            seed, step = identity
+            if identity_max.get(column.name) is not None:
+                seed = max(seed, identity_max[column.name] + step)
+            column = Column(column.name, column.type, column.encode, column.nullable,
+                            "GENERATED BY DEFAULT AS IDENTITY({},{})".format(seed, step))
+        columns.append(column)
+    rebuilt = TableSpec(spec.name, columns, spec.diststyle, spec.distkey, spec.sortkey, spec.constraints)
+    copied = [column for column in spec.columns if column.name in current_columns]
+    select = ", ".join("CAST({} AS {})".format(column.name, column.type)
+                       if normalize_type(column.type) != current_columns[column.name] else column.name
+                       for column in copied)
+    return ["ALTER TABLE {} RENAME TO {}".format(spec.name, old),
+            create_table_sql(rebuilt),
+            "INSERT INTO {} ({}) SELECT {} FROM {}".format(spec.name, ", ".join(c.name for c in copied), select, old),
+            "DROP TABLE {}".format(old)]
+
+
+def _column_changes(spec, current):
+    """This function compares the columns of a spec with the current ones of
+    its table. Returns (rebuild needed, ADD COLUMN statements, in place
+    ALTER COLUMN TYPE statements).
+    """
+    rebuild, statements, in_place = False, [], []
+    for column in spec.columns:
+        desired = normalize_type(column.type)
+        if column.name not in current:
+            if not column.nullable or column.extra:
+                rebuild = True
+            else:
+                statements.append("ALTER TABLE {} ADD COLUMN {}".format(spec.name, column.render()))
+        elif current[column.name] != desired:
+            if _is_widening(current[column.name], desired):
+                in_place.append("ALTER TABLE {} ALTER COLUMN {} TYPE {}".format(spec.name, column.name, column.type))
+            else:
+                rebuild = True
+    return rebuild, statements, in_place
+
+
+def plan_migration(specs, catalog, physical=None, drop_columns=False, stats=None, dependents=DEPENDENT_VIEWS):
+    """This function compares the desired table specs with the current
+    catalog (see read_catalog / read_physical_design / read_table_stats) and
+    returns the list of MigrationSteps needed :
+        missing table           -> CREATE TABLE
+        missing column          -> ALTER TABLE ADD COLUMN
+        varchar made longer     -> ALTER COLUMN TYPE (in place)
+        any other type change,
+        NOT NULL/IDENTITY added -> deep copy of the table; staging tables
+                                   (stg_*) are dropped and created instead
+        dist / sort key changed -> ALTER DISTKEY / DISTSTYLE / SORTKEY
+        extra column            -> dropped only with drop_columns=True
+    A deep copy only makes a varchar shorter when 'stats' shows its longest
+    value fits; ValueError is raised otherwise, as the copy would truncate it.
+    Views of 'dependents' on a table deep copied, altered in place or given
+    new keys are dropped before the change and created again after it.
+    """
+    steps = []
+    stats = stats or {}
+    for spec in specs:
+        current = catalog.get(spec.name)
+        if current is None:
+            steps.append(MigrationStep("create table {}".format(spec.name), [create_table_sql(spec)]))
+            continue
+
+        rebuild, statements, in_place = _column_changes(spec, current)
+        views = (dependents or {}).get(spec.name, [])
+        drop_views = [view.drop_sql() for view in views]
+        create_views = [view.create_sql() for view in views]
+        extra = [name for name in current if name not in [column.name for column in spec.columns]]
+
+        if rebuild and spec.name.startswith(STAGING_PREFIX):
+            # staged rows are reloaded by the next run, and may not even cast
+            # to the new types (e.g. stg_events.ts over epoch milliseconds)
+            steps.append(MigrationStep("recreate staging table {}".format(spec.name),
+                                       ["DROP TABLE {}".format(spec.name), create_table_sql(spec)]))
+            continue
+        if rebuild:
+            table_stats = stats.get(spec.name, {})
+            for name, length in narrowed_columns(spec, current):
+                if name not in table_stats or (table_stats[name] or 0) > length:
+                    raise ValueError("{}.{} : refusing to narrow {} to varchar({}), longest value : {} bytes".format(
+                        spec.name, name, current[name], length, table_stats.get(name, 'unknown')))
+            steps.append(MigrationStep("deep copy {}".format(spec.name),
+                                       drop_views + deep_copy(spec, current, table_stats) + create_views))
+            continue
+        if statements:
+            steps.append(MigrationStep("add columns to {}".format(spec.name), statements))
+        altered = []
+        if in_place:
+            altered.append(MigrationStep("widen columns of {}".format(spec.name), in_place, transactional=False))
+        if extra and drop_columns:
+            altered.append(MigrationStep("drop columns of {}".format(spec.name),
+                                         ["ALTER TABLE {} DROP COLUMN {}".format(spec.name, name) for name in extra]))
+        elif extra:
+            print("{} : columns not in spec kept : {}".format(spec.name, ", ".join(extra)))
+
+        if physical and spec.name in physical:
+            diststyle, distkey, sortkey = physical[spec.name]
+            keys = []
+            if spec.diststyle == 'KEY' and distkey != spec.distkey:
+                keys.append("ALTER TABLE {} ALTER DISTKEY {}".format(spec.name, spec.distkey))
+            elif spec.diststyle != 'KEY' and diststyle != spec.diststyle:
+                keys.append("ALTER TABLE {} ALTER DISTSTYLE {}".format(spec.name, spec.diststyle))
+            if spec.sortkey and sortkey != spec.sortkey:
+                keys.append("ALTER TABLE {} ALTER COMPOUND SORTKEY ({})".format(spec.name, ", ".join(spec.sortkey)))
+            if keys:
+                altered.append(MigrationStep("change keys of {}".format(spec.name), keys, transactional=False))
+        if altered and views:
+            altered = ([MigrationStep("drop views on {}".format(spec.name), drop_views)] + altered +
+                       [MigrationStep("recreate views on {}".format(spec.name), create_views)])
+        steps.extend(altered)
+    return steps
+
+
+def migrate(pool, specs, redshift=True, drop_columns=False, dry_run=False):
+    """This function brings the database schema to the desired specs without
+    dropping data, and records the applied version in schema_versions.
+    Returns the list of MigrationSteps (planned only, with dry_run=True :
+    the catalog is only read, in a transaction rolled back, and
+    schema_versions is not created when missing).
+    """
+    names = [spec.name for spec in specs]
+    version = schema_version(specs)
+    with (pool.sandbox() if dry_run else pool.transaction()) as cur:
+        latest = None
+        if not dry_run:
+            cur.execute(schema_versions_create)
+        if not dry_run or read_catalog(cur, ['schema_versions']):
+            cur.execute("select version from schema_versions order by applied_at desc limit 1")
+            latest = cur.fetchone()
+        catalog = read_catalog(cur, names)
+        physical = read_physical_design(cur, names) if redshift else None
+        stats = read_table_stats(cur, specs, catalog)
+    steps = plan_migration(specs, catalog, physical, drop_columns, stats)
+    for step in steps:
+        print("{}migration : {}".format("(dry run) " if dry_run else "", step.description))
+    if dry_run or (not steps and latest and latest[0] == version):
+        return steps
+
+    for step in steps:
+        if step.transactional:
+            with pool.transaction() as cur:
+                for query in step.statements:
+                    cur.execute(query)
+        else:
+            with pool.autocommit() as cur:
+                for query in step.statements:
+                    cur.execute(query)
+
+    with pool.transaction() as cur:
+        cur.execute("INSERT INTO schema_versions (version, applied_at, statements) VALUES (%s, %s, %s)",
+                    (version, datetime.now(timezone.utc).replace(tzinfo=None),
+                     ";\n".join(q for step in steps for q in step.statements)[:65535]))
+    return steps
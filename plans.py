@@ -0,0 +1,469 @@
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from datetime import date, datetime, timezone
+
+import psycopg2
+
+from connection_pool import ConnectionPool, pool_from_config
+from ledger import partition_values, staged_partitions
+from run_context import RunContext, render
+from sql_queries import query_names, process_table_chains, changed_key_chains, partitioned_chains
+
+
+# Query plan baselines for the catalog statements. capture() EXPLAINs every
+# statement of the merge chains against the current schema & data, parse_plan()
+# turns the plan text into a tree of PlanNodes, and compare_captures() flags
+# what changed since the baseline : data redistribution (DS_BCAST / DS_DIST)
+# or nested loops that were not there are regressions. Parsing & comparing
+# only need the captured text, so they run offline.
+
+# join distribution attributes that move rows between slices at run time
+REDISTRIBUTION = ('DS_BCAST_INNER', 'DS_DIST_INNER', 'DS_DIST_OUTER', 'DS_DIST_ALL_INNER', 'DS_DIST_BOTH')
+
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete', 'merge')
+
+_NODE = re.compile(r'^(?P<indent>\s*)(?:->\s+)?(?P<body>.+?)\s+'
+                   r'\(cost=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+) rows=(?P<rows>\d+) width=(?P<width>\d+)\)')
+_DISTRIBUTION = re.compile(r'\s+(DS_[A-Z_]+)\b')
+_RELATION = re.compile(r'^(?P<operation>.+?) on (?P<relation>\S+)(?: (?P<alias>\S+))?$')
+# the query of CREATE TABLE ... AS / INSERT INTO ... SELECT
+_QUERY = re.compile(r'^\s*(?:create\s[^(]*?\sas|insert\s+into\s+\S+\s*(?:\([^)]*\))?)\s*(?=(?:select|with)\b)',
+                    re.IGNORECASE | re.DOTALL)
+_CREATED = re.compile(r'^\s*create\s+(?:temp\s+|temporary\s+)?table\s+(\S+)', re.IGNORECASE)
+
+
+class PlanNode:
+    """One step of a query plan.
+        operation    - e.g. 'Hash Join', 'Seq Scan', 'Network'
+        relation     - table scanned, for scans
+        distribution - join distribution attribute (Redshift), e.g. 'DS_DIST_NONE'
+        details      - the lines under the step, e.g. 'Hash Cond: ...', 'Distribute'
+    """
+
+    def __init__(self, operation, relation=None, distribution=None, startup_cost=0.0, total_cost=0.0,
+                 rows=0, width=0):
+        self.operation = operation
+        self.relation = relation
+        self.distribution = distribution
+        self.startup_cost = startup_cost
+        self.total_cost = total_cost
+        self.rows = rows
+        self.width = width
+        self.details = []
+        self.children = []
+
+    @property
+    def is_join(self):
+        return 'Join' in self.operation or 'Nested Loop' in self.operation
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def label(self):
+        parts = [self.operation]
+        if self.relation:
+            parts.append("on " + self.relation)
+        if self.distribution:
+            parts.append(self.distribution)
+        return " ".join(parts)
+
+
+class Plan:
+    """Parsed EXPLAIN output : the root PlanNode and the planner warnings
+    (Redshift '----- ... -----' lines, e.g. tables missing statistics)
+    """
+
+    def __init__(self, root, warnings=None):
+        self.root = root
+        self.warnings = warnings or []
+
+    def nodes(self):
+        return list(self.root.walk()) if self.root else []
+
+    def joins(self):
+        return [node for node in self.nodes() if node.is_join]
+
+    def redistributions(self):
+        """Returns the labels of the joins moving rows between slices"""
+        return [node.label() for node in self.joins() if node.distribution in REDISTRIBUTION]
+
+    def nested_loops(self):
+        return [node.label() for node in self.nodes() if 'Nested Loop' in node.operation]
+
+    def summary(self):
+        return {'cost'             : self.root.total_cost if self.root else None,
+                'rows'             : self.root.rows if self.root else None,
+                'joins'            : [node.label() for node in self.joins()],
+                'redistributions'  : self.redistributions(),
+                'nested_loops'     : len(self.nested_loops()),
+                'warnings'         : self.warnings}
+
+
+def _parse_body(body):
+    body = re.sub(r'^(XN|LD)\s+', '', body.strip())
+    distribution = None
+    match = _DISTRIBUTION.search(body)
+    if match:
+        distribution = match.group(1)
+        body = _DISTRIBUTION.sub('', body).strip()
+    match = _RELATION.match(body)
+    if match:
+        return match.group('operation'), match.group('relation'), distribution
+    return body, None, distribution
+
+
+def parse_plan(text):
+    """This function parses the text of an EXPLAIN (Redshift or PostgreSQL,
+    one plan line per row) into a Plan. A step is nested under the closest
+    less indented step above it; lines without a cost are details of the
+    step above them.
+    """
+    lines = text.splitlines() if isinstance(text, str) else list(text)
+    root, stack, warnings = None, [], []
+    for line in lines:
+        if not line.strip():
+            continue
+        if line.strip().startswith('-----'):
+            warnings.append(line.strip().strip('-').strip())
+            continue
+        match = _NODE.match(line)
+        if not match:
+            if stack:
+                stack[-1][1].details.append(line.strip())
+            continue
+        operation, relation, distribution = _parse_body(match.group('body'))
+        node = PlanNode(operation, relation, distribution, float(match.group('startup')),
+                        float(match.group('total')), int(match.group('rows')), int(match.group('width')))
+        indent = len(match.group('indent'))
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1].children.append(node)
+        elif root is None:
+            root = node
+        stack.append((indent, node))
+    return Plan(root, warnings)
+
+
+class Finding:
+    """One difference between the baseline and the current plan of a statement.
+    severity is 'regression' (new redistribution or nested loop) or 'change'.
+    """
+
+    def __init__(self, statement, severity, message):
+        self.statement = statement
+        self.severity = severity
+        self.message = message
+
+    def __str__(self):
+        return "{:<10} {:<32} {}".format(self.severity.upper(), self.statement, self.message)
+
+
+def _added(before, after):
+    return sorted((Counter(after) - Counter(before)).elements())
+
+
+def compare_plans(statement, baseline, current, cost_threshold=2.0):
+    """This function returns the Findings between two Plans of 'statement' :
+        regression - a join redistributing rows, or a nested loop, that the
+                     baseline did not have
+        change     - other join changes, new planner warnings, or a total
+                     cost more than 'cost_threshold' times the baseline's
+    """
+    findings = []
+    for label in _added(baseline.redistributions(), current.redistributions()):
+        findings.append(Finding(statement, 'regression', "new redistribution : " + label))
+    for label in _added(baseline.nested_loops(), current.nested_loops()):
+        findings.append(Finding(statement, 'regression', "new nested loop : " + label))
+
+    joins_before = [node.label() for node in baseline.joins()]
+    joins_after = [node.label() for node in current.joins()]
+    if Counter(joins_before) != Counter(joins_after):
+        findings.append(Finding(statement, 'change', "joins {} -> {}".format(joins_before, joins_after)))
+    for warning in _added(baseline.warnings, current.warnings):
+        findings.append(Finding(statement, 'change', "new warning : " + warning))
+
+    cost_before = baseline.root.total_cost if baseline.root else 0
+    cost_after = current.root.total_cost if current.root else 0
+    if cost_threshold and cost_before and cost_after > cost_before * cost_threshold:
+        findings.append(Finding(statement, 'change', "cost {:.2f} -> {:.2f}".format(cost_before, cost_after)))
+    return findings
+
+
+def compare_captures(baseline, current, cost_threshold=2.0):
+    """This function compares two captures (see capture()) statement by
+    statement and returns the list of Findings. Statements without a
+    baseline plan are reported as changes, never as regressions.
+    """
+    findings = []
+    for name, entry in current['statements'].items():
+        before = baseline['statements'].get(name)
+        if 'plan' not in entry:
+            findings.append(Finding(name, 'change', "not explained : {}".format(entry.get('error'))))
+            continue
+        if not before or 'plan' not in before:
+            findings.append(Finding(name, 'change', "no baseline plan"))
+            continue
+        if before['sql_digest'] != entry['sql_digest']:
+            findings.append(Finding(name, 'change', "statement text changed"))
+        findings.extend(compare_plans(name, parse_plan(before['plan']), parse_plan(entry['plan']), cost_threshold))
+    return findings
+
+
+def sql_digest(query):
+    return hashlib.sha256(str(query).encode('utf-8')).hexdigest()[:16]
+
+
+def is_explainable(sql):
+    """Statements reading data : DML and CREATE TABLE ... AS"""
+    words = sql.split()
+    if not words:
+        return False
+    first = words[0].lower()
+    if first == 'create':
+        return ' as ' in ' '.join(words[:8]).lower() + ' '
+    return first in EXPLAINABLE
+
+
+def _capture_chain(pool, statements, names, context, skip):
+    """This function EXPLAINs the statements of one chain not in 'skip' (names)
+    in a sandbox : work tables are really created, so the statements reading
+    them are planned against their rows, then everything is rolled back.
+    Other DML is only explained. A statement failing to EXPLAIN (e.g. MERGE
+    on Redshift) is recorded with its error and the chain captured again
+    without it, since the failure aborts the transaction.
+    """
+    plans, failed = {}, set()
+    while True:
+        explaining = None
+        try:
+            with pool.sandbox() as cur:
+                for query in statements:
+                    name = names.get(query) or ' '.join(str(query).split()[:3])
+                    sql = render(query, context)
+                    first = sql.split()[0].lower()
+                    if name not in skip and name not in failed and is_explainable(sql):
+                        explaining = name
+                        cur.execute("EXPLAIN " + sql)
+                        plans[name] = {'sql_digest' : sql_digest(query),
+                                       'plan'       : [row[0] for row in cur.fetchall()]}
+                        explaining = None
+                    if first in ('create', 'drop'):
+                        cur.execute(sql)
+            return plans
+        except psycopg2.Error as e:
+            if explaining is None:
+                raise
+            failed.add(explaining)
+            plans[explaining] = {'sql_digest' : sql_digest(query),
+                                 'error'      : str(e).strip()}
+
+
+def capture(pool, context, chains, partitioned=(), names=query_names):
+    """This function returns the plans of every explainable statement of
+    'chains' (chain name -> statements; a statement shared by chains is
+    captured once). Partitioned chains are planned for the latest day of
+    refined plays (stg_plays, as left by the last refinement).
+    """
+    with pool.transaction() as cur:
+        days = staged_partitions(cur)
+    day = days[-1] if days else date.today()
+    statements = {}
+    for chain, chain_statements in chains.items():
+        chain_context = context.with_values(**partition_values(day)) if chain in partitioned else context
+        statements.update(_capture_chain(pool, chain_statements, names, chain_context, set(statements)))
+    return {'captured_at' : datetime.now(timezone.utc).isoformat(),
+            'partition'   : day.isoformat(),
+            'statements'  : statements}
+
+
+def select_part(sql):
+    """Returns the SELECT of a CREATE TABLE ... AS or INSERT ... SELECT
+    statement, the statement itself for a query, None otherwise
+    """
+    match = _QUERY.match(sql)
+    if match:
+        return sql[match.end():]
+    words = sql.split()
+    return sql if words and words[0].lower() in ('select', 'with') else None
+
+
+def estimate(pool, context, chains, partitioned=(), names=query_names):
+    """This function EXPLAINs only the SELECT of the statements of 'chains'
+    (see select_part) : nothing is created or written, unlike capture(), so
+    a statement reading a work table of its chain is not explained.
+    Partitioned chains are planned for the latest day of refined plays.
+    Returns dict of statement name -> {'plan'} or {'error'}.
+    """
+    with pool.transaction() as cur:
+        days = staged_partitions(cur)
+    day = days[-1] if days else date.today()
+    estimates = {}
+    for chain, chain_statements in chains.items():
+        chain_context = context.with_values(**partition_values(day)) if chain in partitioned else context
+        created = []
+        for query in chain_statements:
+            name = names.get(query) or ' '.join(str(query).split()[:3])
+            sql = render(query, chain_context)
+            if _CREATED.match(sql):
+                created.append(_CREATED.match(sql).group(1).lower())
+            sql = select_part(sql)
+            if sql is None or name in estimates:
+                continue
+            reads = [table for table in created if re.search(r'\b{}\b'.format(re.escape(table)), sql, re.IGNORECASE)]
+            if reads:
+                estimates[name] = {'error': "reads work table {}".format(reads[0])}
+                continue
+            try:
+                with pool.sandbox() as cur:
+                    cur.execute("EXPLAIN " + sql)
+                    estimates[name] = {'plan': [row[0] for row in cur.fetchall()]}
+            except psycopg2.Error as e:
+                estimates[name] = {'error': str(e).strip().splitlines()[0]}
+    return {'partition' : day.isoformat(), 'statements' : estimates}
+
+
+def catalog_chains():
+    """Returns every chain of sql_queries.py : the merge chains, then the
+    changed-keys versions of the cached dimensions
+    """
+    chains = dict(process_table_chains)
+    chains.update({name + '_changed': statements for name, statements in changed_key_chains.items()})
+    return chains
+
+
+# Captured plans shipped with the code, one baseline & current capture per
+# engine, whose comparison must flag exactly these regressions. selfcheck()
+# runs the parser, the comparison and select_part() on them offline.
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plan_samples')
+SAMPLE_REGRESSIONS = {
+    'redshift' : ["new redistribution : Nested Loop DS_BCAST_INNER",
+                  "new nested loop : Nested Loop DS_BCAST_INNER"],
+    'postgres' : ["new nested loop : Nested Loop"],
+}
+
+
+def selfcheck(samples_dir=SAMPLES_DIR):
+    """This function checks the plan parsing & comparison against the sample
+    captures of 'samples_dir' (<engine>_baseline.json, <engine>_current.json),
+    and that select_part() finds the query of every CREATE TABLE ... AS of
+    the catalog. Returns the list of problems found, empty when all is well.
+    """
+    problems = []
+    for engine, expected in SAMPLE_REGRESSIONS.items():
+        baseline = read_capture(os.path.join(samples_dir, engine + '_baseline.json'))
+        current = read_capture(os.path.join(samples_dir, engine + '_current.json'))
+        for capture_name, captured in (('baseline', baseline), ('current', current)):
+            for name, entry in captured['statements'].items():
+                plan = parse_plan(entry['plan'])
+                scanned = {node.relation for node in plan.nodes()}
+                if plan.root is None or not plan.root.total_cost or not plan.joins():
+                    problems.append("{} {} {} : no costed root or no join parsed".format(engine, capture_name, name))
+                if not {'stg_plays', 'song_match'} <= scanned:
+                    problems.append("{} {} {} : scans parsed {}".format(engine, capture_name, name,
+                                                                        sorted(scanned - {None})))
+        if compare_captures(baseline, baseline):
+            problems.append("{} : baseline differs from itself".format(engine))
+        found = [finding.message for finding in compare_captures(baseline, current) if finding.severity == 'regression']
+        if sorted(found) != sorted(expected):
+            problems.append("{} : regressions {} instead of {}".format(engine, found, expected))
+    for statements in catalog_chains().values():
+        for query in statements:
+            sql = str(query)
+            if sql.split()[0].lower() == 'create' and ' as ' in sql.lower():
+                part = select_part(sql)
+                if not part or part.split()[0].lower() not in ('select', 'with'):
+                    problems.append("select_part : no query found in {}".format(query_names.get(query)))
+    return problems
+
+
+def read_capture(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_capture(path, captured):
+    with open(path, 'w') as f:
+        json.dump(captured, f, indent=2)
+
+
+def connect(args):
+    """Returns the pool for --dsn (a local PostgreSQL, statements shimmed as
+    in the benchmark) or for the cluster of dwh.cfg
+    """
+    if args.dsn:
+        from benchmark import ShimCursor
+        return ConnectionPool(args.dsn, wrap_cursor=ShimCursor), RunContext(None)
+    import boto3
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    redshift = boto3.client('redshift',
+                   region_name="us-west-2",
+                   aws_access_key_id=config.get('AWS','KEY'),
+                   aws_secret_access_key=config.get('AWS','SECRET')
+                   )
+    cluster = redshift.describe_clusters(ClusterIdentifier=config.get("CLUSTER","CLS_IDENTIFIER"))['Clusters'][0]
+    return pool_from_config(config, cluster['Endpoint']['Address']), RunContext(config,
+                                                                                role_arn=cluster['IamRoles'][0]['IamRoleArn'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture & check the query plans of the catalog statements")
+    parser.add_argument('command', choices=['capture', 'check', 'diff', 'selfcheck'],
+                        help="capture : write the baseline; check : capture and compare with the baseline; "
+                             "diff : compare two capture files offline; "
+                             "selfcheck : check the parser & comparison on the plan_samples captures offline")
+    parser.add_argument('current', nargs='?', help="capture file compared by diff")
+    parser.add_argument('--baseline', default='plan_baselines.json')
+    parser.add_argument('--output', help="check : also write the current capture to this file")
+    parser.add_argument('--dsn', help="local PostgreSQL instead of the cluster of dwh.cfg")
+    parser.add_argument('--cost-threshold', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.command == 'selfcheck':
+        problems = selfcheck()
+        for problem in problems:
+            print(problem)
+        print("plan samples : {} problem(s)".format(len(problems)))
+        if problems:
+            raise SystemExit(1)
+        return
+    if args.command == 'diff':
+        if not args.current:
+            parser.error("diff needs the capture file to compare with --baseline")
+        current = read_capture(args.current)
+    else:
+        pool, context = connect(args)
+        try:
+            current = capture(pool, context, catalog_chains(), partitioned_chains)
+        finally:
+            pool.closeall()
+        if args.command == 'capture':
+            write_capture(args.baseline, current)
+            for name, entry in current['statements'].items():
+                summary = parse_plan(entry['plan']).summary() if 'plan' in entry else {'error': entry['error']}
+                print("{:<32} {}".format(name, json.dumps(summary)))
+            print("{} plan(s) written to {}".format(len(current['statements']), args.baseline))
+            return
+        if args.output:
+            write_capture(args.output, current)
+
+    findings = compare_captures(read_capture(args.baseline), current, args.cost_threshold)
+    for finding in findings:
+        print(finding)
+    regressions = [finding for finding in findings if finding.severity == 'regression']
+    print("{} statement(s), {} change(s), {} regression(s)".format(
+        len(current['statements']), len(findings) - len(regressions), len(regressions)))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
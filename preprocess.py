@@ -0,0 +1,239 @@
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from manifest import list_objects, split_s3_url
+from schema import stg_events_spec, stg_songs_spec
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+
+# stg_events column -> field of the log_data JSON, same mapping as LOG_JSONPATH
+EVENTS_FIELDS = {
+    'artist_name'   : 'artist',
+    'ev_auth'       : 'auth',
+    'first_name'    : 'firstName',
+    'gender'        : 'gender',
+    'iteminsession' : 'itemInSession',
+    'last_name'     : 'lastName',
+    'ev_length'     : 'length',
+    'level'         : 'level',
+    'location'      : 'location',
+    'method'        : 'method',
+    'page'          : 'page',
+    'registration'  : 'registration',
+    'sessionid'     : 'sessionId',
+    'song_title'    : 'song',
+    'status'        : 'status',
+    'ts'            : 'ts',
+    'useragent'     : 'userAgent',
+    'userid'        : 'userId',
+}
+
+# stg_songs columns carry the song_data field names, as with json 'auto'
+SONGS_FIELDS = {column.name: column.name for column in stg_songs_spec.columns}
+
+# feed name -> (staging table spec, column -> JSON field)
+FEEDS = {
+    'log_data'  : (stg_events_spec, EVENTS_FIELDS),
+    'song_data' : (stg_songs_spec, SONGS_FIELDS),
+}
+
+
+def iter_json_files(root):
+    """This function yields the path of every .json file under 'root', sorted"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.json'):
+                yield os.path.join(dirpath, filename)
+
+
+def iter_records(paths):
+    """This function yields one dict per JSON record, reading the files line
+    by line. Handles both JSON-lines files (log_data) and files holding a
+    single object (song_data).
+    """
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def iter_rows(records, spec, fields):
+    """This function maps JSON records to staging rows (tuples in the column
+    order of the staging table). Missing and empty values become None.
+    """
+    columns = [fields[column.name] for column in spec.columns]
+    for record in records:
+        yield tuple(None if record.get(field) in (None, '') else record.get(field)
+                    for field in columns)
+
+
+def write_csv_chunks(rows, out_dir, prefix, num_chunks):
+    """This function streams rows round-robin into 'num_chunks' gzip CSV files,
+    so the files end up within one row of each other in size. Only one row
+    is held in memory at a time. Returns the list of file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [os.path.join(out_dir, "{}.{:04d}.csv.gz".format(prefix, n)) for n in range(num_chunks)]
+    files = [gzip.open(path, 'wt', encoding='utf-8', newline='') for path in paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for n, row in enumerate(rows):
+            writers[n % num_chunks].writerow(['' if value is None else value for value in row])
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+# Parquet COPY has no timeformat option and maps Parquet types onto the
+# column types as is : every chunk is written with the staging table's own
+# schema, whatever the values of one batch look like
+EPOCH = datetime(1970, 1, 1)
+
+
+def _arrow_column(column):
+    """This function returns (pyarrow type, converter) for one column of a
+    staging table spec; the converter turns a JSON value into that type.
+    """
+    base = column.type.split('(')[0].strip().lower()
+    if base in ('varchar', 'char'):
+        return pyarrow.string(), str
+    if base == 'smallint':
+        return pyarrow.int16(), int
+    if base == 'int':
+        return pyarrow.int32(), int
+    if base == 'bigint':
+        return pyarrow.int64(), int
+    if base in ('numeric', 'decimal'):
+        precision, scale = [int(part) for part in column.type[len(base) + 1:-1].split(',')]
+        quantum = Decimal(1).scaleb(-scale)
+        return pyarrow.decimal128(precision, scale), lambda value: Decimal(str(value)).quantize(quantum)
+    if base == 'timestamp':
+        # epoch milliseconds are written as real timestamps
+        return pyarrow.timestamp('ms'), lambda value: EPOCH + timedelta(milliseconds=value)
+    raise ValueError("{} : no Parquet type for '{}'".format(column.name, column.type))
+
+
+def arrow_schema(spec):
+    """This function returns the pyarrow schema of a staging table spec and
+    the list of per-column converters matching it. Needs pyarrow.
+    """
+    types, converters = zip(*[_arrow_column(column) for column in spec.columns])
+    schema = pyarrow.schema([pyarrow.field(column.name, arrow_type, nullable=column.nullable)
+                             for column, arrow_type in zip(spec.columns, types)])
+    return schema, list(converters)
+
+
+def write_parquet_chunks(rows, out_dir, prefix, num_chunks, spec, batch_size=50000):
+    """This function streams rows round-robin into 'num_chunks' Parquet files,
+    buffering at most 'batch_size' rows per file. Every file has the schema
+    of the staging table 'spec' (see arrow_schema). Needs pyarrow.
+    Returns the list of file paths.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Parquet output needs pyarrow : pip install pyarrow")
+    os.makedirs(out_dir, exist_ok=True)
+    names = [column.name for column in spec.columns]
+    schema, converters = arrow_schema(spec)
+
+    def typed(row):
+        return tuple(None if value is None else convert(value) for value, convert in zip(row, converters))
+
+    paths = [os.path.join(out_dir, "{}.{:04d}.parquet".format(prefix, n)) for n in range(num_chunks)]
+    writers, buffers = [None] * num_chunks, [[] for _ in range(num_chunks)]
+
+    def flush(n):
+        if not buffers[n]:
+            return
+        table = pyarrow.Table.from_pylist([dict(zip(names, row)) for row in buffers[n]], schema=schema)
+        if writers[n] is None:
+            writers[n] = pq.ParquetWriter(paths[n], schema, compression='snappy')
+        writers[n].write_table(table)
+        buffers[n] = []
+
+    try:
+        for i, row in enumerate(rows):
+            n = i % num_chunks
+            buffers[n].append(typed(row))
+            if len(buffers[n]) >= batch_size:
+                flush(n)
+        for n in range(num_chunks):
+            flush(n)
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+    return [path for path, writer in zip(paths, writers) if writer is not None]
+
+
+def preprocess_feed(feed, source_dir, out_dir, num_chunks, output_format='csv'):
+    """This function converts one local feed (log_data or song_data) into
+    'num_chunks' staging files ready for COPY. Returns (paths, row count).
+    """
+    spec, fields = FEEDS[feed]
+    counter = {'rows': 0}
+
+    def counted(rows):
+        for row in rows:
+            counter['rows'] += 1
+            yield row
+
+    rows = counted(iter_rows(iter_records(iter_json_files(source_dir)), spec, fields))
+    if output_format == 'parquet':
+        paths = write_parquet_chunks(rows, out_dir, feed, num_chunks, spec)
+    else:
+        paths = write_csv_chunks(rows, out_dir, feed, num_chunks)
+    return paths, counter['rows']
+
+
+def slice_count(cur):
+    """This function returns the number of slices of the cluster"""
+    cur.execute("select count(*) from stv_slices")
+    return cur.fetchone()[0]
+
+
+def upload_chunks(s3, paths, url_prefix):
+    """This function replaces the chunk files under the S3 prefix 'url_prefix'
+    with 'paths'. Chunks left by an earlier run are deleted first, so a COPY
+    of the prefix only sees this run's files.
+    """
+    bucket, prefix = split_s3_url(url_prefix.rstrip('/'))
+    stale = [{'Key': obj['key']} for obj in list_objects(s3, "s3://{}/{}/".format(bucket, prefix))]
+    for start in range(0, len(stale), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': stale[start:start + 1000]})
+    for path in paths:
+        s3.upload_file(path, bucket, "{}/{}".format(prefix, os.path.basename(path)))
+
+
+def main():
+    """Local benchmark :
+        python preprocess.py <log_data dir> <song_data dir> <out dir> [chunks] [csv|parquet]
+    """
+    log_dir, song_dir, out_dir = sys.argv[1:4]
+    num_chunks = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    output_format = sys.argv[5] if len(sys.argv) > 5 else 'csv'
+    for feed, source_dir in (('log_data', log_dir), ('song_data', song_dir)):
+        start = time.perf_counter()
+        paths, rows = preprocess_feed(feed, source_dir, os.path.join(out_dir, feed), num_chunks, output_format)
+        seconds = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in paths)
+        print("{:<10} {:>10} rows {:>8.2f}s {:>10.0f} rows/s {:>12} bytes in {} file(s)".format(
+            feed, rows, seconds, rows / seconds if seconds else 0, size, len(paths)))
+
+
+if __name__ == "__main__":
+    main()
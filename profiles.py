@@ -0,0 +1,109 @@
+# Workload-management execution profiles. A profile attached to a catalog
+# statement (sql_queries.query_profiles) names the WLM query group it runs
+# in, the number of query slots (memory) it takes, and the tables to ANALYZE
+# or VACUUM once the merges are done. Maintenance only runs when
+# svv_table_info shows the statistics or the sort order drifted.
+
+SETTINGS = ('query_group', 'wlm_query_slot_count')
+
+
+class Profile:
+    """Execution profile of one statement.
+        query_group - WLM query group, routes the statement to its queue
+        slot_count  - query slots taken in that queue (more memory, less spill),
+                      None keeps the session value
+        analyze     - table to ANALYZE after the run when its stats drifted
+        vacuum      - table to VACUUM SORT ONLY when too much of it is unsorted
+    """
+
+    def __init__(self, query_group='etl', slot_count=None, analyze=None, vacuum=None):
+        self.query_group = query_group
+        self.slot_count = slot_count
+        self.analyze = analyze
+        self.vacuum = vacuum
+
+    def settings(self):
+        settings = {'query_group' : self.query_group}
+        if self.slot_count is not None:
+            settings['wlm_query_slot_count'] = str(self.slot_count)
+        return settings
+
+
+class ProfileSwitcher:
+    """Applies profiles to one cursor : only settings that differ from the
+    ones in effect are SET, and restore() puts back the session values
+    (the [SESSION] settings of the pool, or the defaults)
+    """
+
+    def __init__(self, cursor, session_settings=None):
+        self._cursor = cursor
+        self._session = {name: str(value) for name, value in (session_settings or {}).items() if name in SETTINGS}
+        self._current = dict(self._session)
+
+    def _switch(self, settings):
+        for name in SETTINGS:
+            value = settings.get(name)
+            if self._current.get(name) == value:
+                continue
+            if value is None:
+                self._cursor.execute("RESET {}".format(name))
+            else:
+                self._cursor.execute("SET {} TO %s".format(name), (value,))
+        self._current = dict(settings)
+
+    def apply(self, profile):
+        self._switch(dict(self._session, **profile.settings()))
+
+    def restore(self):
+        self._switch(self._session)
+
+
+def maintenance_targets(chains, profiles):
+    """This function returns (tables to analyze, tables to vacuum) named by
+    the profiles of the statements of 'chains' (chain name -> statements)
+    """
+    analyze, vacuum = set(), set()
+    for statements in chains.values():
+        for query in statements:
+            profile = profiles.get(query)
+            if profile and profile.analyze:
+                analyze.add(profile.analyze)
+            if profile and profile.vacuum:
+                vacuum.add(profile.vacuum)
+    return analyze, vacuum
+
+
+def table_health(cur, tables):
+    """This function returns table -> (stats_off, unsorted) percentages from
+    svv_table_info (Redshift); tables without rows are not listed there
+    """
+    cur.execute("""select "table", stats_off, unsorted from svv_table_info where "table" in %s""",
+                (tuple(tables),))
+    return {table.strip(): (float(stats_off or 0), float(unsorted or 0)) for table, stats_off, unsorted in cur.fetchall()}
+
+
+def maintain(pool, analyze, vacuum, analyze_threshold=10.0, vacuum_threshold=20.0):
+    """This function runs ANALYZE on the 'analyze' tables whose stats_off is
+    above 'analyze_threshold' and VACUUM SORT ONLY on the 'vacuum' tables
+    more than 'vacuum_threshold' percent unsorted. VACUUM cannot run in a
+    transaction block, so both run in autocommit. Returns the statements run.
+    """
+    tables = set(analyze) | set(vacuum)
+    if not tables:
+        return []
+    with pool.transaction() as cur:
+        health = table_health(cur, tables)
+    statements = []
+    for table in sorted(vacuum):
+        if health.get(table, (0, 0))[1] > vacuum_threshold:
+            statements.append("VACUUM SORT ONLY {}".format(table))
+    for table in sorted(analyze):
+        if health.get(table, (0, 0))[0] > analyze_threshold:
+            statements.append("ANALYZE {}".format(table))
+    with pool.autocommit() as cur:
+        for query in statements:
+            cur.execute(query)
+    for table in sorted(tables):
+        stats_off, unsorted = health.get(table, (0, 0))
+        print("{:<12} stats_off {:>6.2f}% unsorted {:>6.2f}%".format(table, stats_off, unsorted))
+    return statements
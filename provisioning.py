@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+
+
+# Async provisioning of the IAM role, Redshift cluster and network access.
+# boto3 calls are blocking, so each one runs in a worker thread; independent
+# calls are awaited together. Clients are passed in, so moto or any other
+# stand-in exposing the same methods can be used.
+
+S3_READ_POLICY       = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+REDSHIFT_FULL_POLICY = "arn:aws:iam::aws:policy/AmazonRedshiftFullAccess"
+
+
+def _error_code(e):
+    """Returns the AWS error code of a botocore ClientError, None otherwise"""
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def report(waiter, **fields):
+    """This function prints one structured progress line"""
+    print(json.dumps(dict(waiter=waiter, **fields), default=str))
+
+
+async def wait_for(name, probe, ready, deadline_seconds, initial_delay=2.0, max_delay=30.0, factor=2.0):
+    """This function polls 'probe' until 'ready(state)' holds.
+        probe            - async callable returning the current state
+        deadline_seconds - overall limit; TimeoutError is raised past it
+    The delay between polls grows by 'factor' up to 'max_delay' while the
+    state stays the same, and drops back to 'initial_delay' when it changes,
+    so a transition is noticed within seconds instead of a fixed interval.
+    Returns the final state.
+    """
+    start = time.monotonic()
+    delay, previous = initial_delay, None
+    while True:
+        state = await probe()
+        elapsed = time.monotonic() - start
+        if ready(state):
+            report(name, status='ready', elapsed=round(elapsed, 1))
+            return state
+        if state != previous:
+            delay, previous = initial_delay, state
+        remaining = deadline_seconds - elapsed
+        if remaining <= 0:
+            raise TimeoutError("{} not ready after {:.0f}s, last state : {}".format(name, elapsed, state))
+        delay = min(delay, remaining)
+        report(name, status='waiting', state=state, elapsed=round(elapsed, 1), next_check=round(delay, 1))
+        await asyncio.sleep(delay)
+        delay = min(delay * factor, max_delay)
+
+
+async def ensure_role(iam, role_name):
+    """This function creates the Redshift IAM role if missing and returns
+    its ARN. Policies are attached separately, see attach_policies().
+    """
+    try:
+        await asyncio.to_thread(iam.create_role,
+            Path='/',
+            RoleName=role_name,
+            Description="Allows Redshift clusters to call AWS services on your behalf.",
+            AssumeRolePolicyDocument=json.dumps(
+                {'Statement': [{'Action': 'sts:AssumeRole',
+                                'Effect': 'Allow',
+                                'Principal': {'Service': 'redshift.amazonaws.com'}}],
+                 'Version': '2012-10-17'}))
+        report('iam_role', status='created', role=role_name)
+    except Exception as e:
+        if _error_code(e) != 'EntityAlreadyExists':
+            raise
+        report('iam_role', status='exists', role=role_name)
+    role = await asyncio.to_thread(iam.get_role, RoleName=role_name)
+    return role['Role']['Arn']
+
+
+async def attach_policies(iam, role_name, policies=(S3_READ_POLICY, REDSHIFT_FULL_POLICY)):
+    """This function attaches the policies to the role, concurrently"""
+    await asyncio.gather(*[asyncio.to_thread(iam.attach_role_policy, RoleName=role_name, PolicyArn=policy)
+                           for policy in policies])
+    report('iam_policies', status='attached', role=role_name)
+
+
+async def ensure_cluster(redshift, config, role_arn):
+    """This function requests the cluster described in dwh.cfg. An existing
+    cluster with the same identifier is reused; any other error is raised.
+    """
+    try:
+        await asyncio.to_thread(redshift.create_cluster,
+            ClusterType=config.get("CLUSTER","CLS_CLUSTER_TYPE"),
+            NodeType=config.get("CLUSTER","CLS_NODE_TYPE"),
+            NumberOfNodes=int(config.get("CLUSTER","CLS_NUM_NODES")),
+            DBName=config.get("DWH","DB_NAME"),
+            ClusterIdentifier=config.get("CLUSTER","CLS_IDENTIFIER"),
+            MasterUsername=config.get("DWH","DB_USER"),
+            MasterUserPassword=config.get("DWH","DB_PASSWORD"),
+            IamRoles=[role_arn])
+        report('cluster', status='requested')
+    except Exception as e:
+        if _error_code(e) != 'ClusterAlreadyExists':
+            raise
+        report('cluster', status='exists')
+
+
+async def wait_cluster_available(redshift, cluster_id, deadline_seconds=1800, **backoff):
+    """This function waits until the cluster is 'available' with an endpoint
+    and returns its description
+    """
+    latest = {}
+
+    async def probe():
+        props = await asyncio.to_thread(redshift.describe_clusters, ClusterIdentifier=cluster_id)
+        latest['props'] = props['Clusters'][0]
+        endpoint = latest['props'].get('Endpoint', {}).get('Address')
+        return (latest['props']['ClusterStatus'], bool(endpoint))
+
+    await wait_for('cluster_status', probe, lambda state: state == ('available', True), deadline_seconds, **backoff)
+    return latest['props']
+
+
+async def wait_port_open(host, port, deadline_seconds=300, connect_timeout=5.0, **backoff):
+    """This function waits until a TCP connection to host:port succeeds"""
+
+    async def probe():
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            return type(e).__name__
+        writer.close()
+        await writer.wait_closed()
+        return 'open'
+
+    await wait_for('tcp_port', probe, lambda state: state == 'open', deadline_seconds, **backoff)
+
+
+async def open_ingress(ec2, redshift, cluster_id, vpc_id, port):
+    """This function allows inbound TCP on the cluster port in the default
+    security group of the cluster VPC and attaches that group to the
+    cluster; both calls run concurrently
+    """
+    vpc = ec2.Vpc(id=vpc_id)
+    security_groups = await asyncio.to_thread(lambda: list(vpc.security_groups.all()))
+    default_sg = next((sg for sg in security_groups if sg.group_name == 'default'), security_groups[0])
+
+    async def authorize():
+        try:
+            await asyncio.to_thread(default_sg.authorize_ingress,
+                GroupName=default_sg.group_name,
+                CidrIp='0.0.0.0/0',
+                IpProtocol='TCP',
+                FromPort=port,
+                ToPort=port)
+        except Exception as e:
+            if _error_code(e) != 'InvalidPermission.Duplicate':
+                raise
+
+    await asyncio.gather(authorize(),
+                         asyncio.to_thread(redshift.modify_cluster,
+                                           ClusterIdentifier=cluster_id,
+                                           VpcSecurityGroupIds=[default_sg.group_id]))
+    report('ingress', status='open', security_group=default_sg.group_id, port=port)
+
+
+async def provision(config, iam, redshift, ec2, check_port=True):
+    """This function brings up the role, cluster and network access described
+    in dwh.cfg and returns (role ARN, cluster endpoint address).
+    Policy attachment runs alongside the cluster request, and the overall
+    readiness wait is bounded by CLS_READY_TIMEOUT ([CLUSTER], seconds).
+    """
+    role_name = config.get("IAM_ROLE", "IAM_ROLE_NAME")
+    cluster_id = config.get("CLUSTER", "CLS_IDENTIFIER")
+    port = int(config.get("DWH", "DB_PORT"))
+    deadline = config.getint("CLUSTER", "CLS_READY_TIMEOUT", fallback=1800)
+
+    start = time.monotonic()
+    role_arn = await ensure_role(iam, role_name)
+    await asyncio.gather(attach_policies(iam, role_name),
+                         ensure_cluster(redshift, config, role_arn))
+    props = await wait_cluster_available(redshift, cluster_id, max(0, deadline - (time.monotonic() - start)))
+    if props.get('VpcId'):
+        await open_ingress(ec2, redshift, cluster_id, props['VpcId'], port)
+    else:
+        report('ingress', status='skipped', reason='cluster is not in a VPC')
+    host = props['Endpoint']['Address']
+    if check_port:
+        # whatever the cluster wait left of the deadline; a port already
+        # open is still noticed by the first probe
+        await wait_port_open(host, port, max(0, deadline - (time.monotonic() - start)))
+    return props['IamRoles'][0]['IamRoleArn'], host
@@ -0,0 +1,159 @@
+import json
+from datetime import datetime, timezone
+
+
+# Load statistics & data-quality checks. Load counts come from Redshift
+# metadata (pg_last_copy_count, stl_load_commits) instead of scanning the
+# staging tables; checks are aggregates pushed down into the warehouse, all
+# checks over the same source evaluated by a single query.
+
+class Check:
+    """One data-quality check, an aggregate evaluated over 'source'.
+        source    - FROM clause, a table or a join
+        max_value - the check fails when the value is above it; None for
+                    values only tracked, e.g. row counts
+        min_delta - when set, the check fails when the value dropped by more
+                    than this since the previous run (0 = must not shrink)
+    """
+
+    def __init__(self, name, source, expression, max_value=0, min_delta=None):
+        self.name = name
+        self.source = source
+        self.expression = expression
+        self.max_value = max_value
+        self.min_delta = min_delta
+
+
+class CheckResult:
+    """Outcome of one Check : value, value of the previous run, passed, detail"""
+
+    def __init__(self, check, value, previous=None):
+        self.name = check.name
+        self.value = value
+        self.previous = previous
+        failures = []
+        if check.max_value is not None and value is not None and value > check.max_value:
+            failures.append("{} > {}".format(value, check.max_value))
+        if check.min_delta is not None and previous is not None and value is not None \
+                and value - previous < -check.min_delta:
+            failures.append("dropped from {} to {}".format(previous, value))
+        self.passed = not failures
+        self.detail = "; ".join(failures)
+
+    def as_dict(self):
+        return {'check'    : self.name,
+                'value'    : self.value,
+                'previous' : self.previous,
+                'passed'   : self.passed,
+                'detail'   : self.detail}
+
+
+def _nulls(column):
+    return "sum(case when {} is null then 1 else 0 end)".format(column)
+
+
+def _duplicates(column):
+    return "count({}) - count(distinct {})".format(column, column)
+
+
+_songplays_joined = """songplays sp
+                       left join songs s on s.song_id = sp.song_id
+                       left join users u on u.user_id = sp.user_id
+                       left join time t on t.start_time = sp.start_time"""
+
+DEFAULT_CHECKS = [
+    Check('songs_rows',             'songs',     "count(*)", max_value=None, min_delta=0),
+    Check('songs_null_song_id',     'songs',     _nulls('song_id')),
+    Check('songs_duplicate_song_id','songs',     _duplicates('song_id')),
+    Check('artists_rows',           'artists',   "count(*)", max_value=None, min_delta=0),
+    Check('artists_null_artist_id', 'artists',   _nulls('artist_id')),
+    Check('artists_duplicate_artist_id', 'artists', _duplicates('artist_id')),
+    Check('users_rows',             'users',     "count(*)", max_value=None, min_delta=0),
+    Check('users_null_user_id',     'users',     _nulls('user_id')),
+    Check('users_duplicate_user_id','users',     _duplicates('user_id')),
+    Check('time_rows',              'time',      "count(*)", max_value=None, min_delta=0),
+    Check('time_duplicate_start_time', 'time',   _duplicates('start_time')),
+    Check('songplays_rows',         _songplays_joined, "count(*)", max_value=None, min_delta=0),
+    Check('songplays_null_keys',    _songplays_joined,
+          "sum(case when sp.start_time is null or sp.user_id is null or sp.session_id is null then 1 else 0 end)"),
+    Check('songplays_orphan_song',  _songplays_joined, "sum(case when s.song_id is null then 1 else 0 end)"),
+    Check('songplays_orphan_user',  _songplays_joined, "sum(case when u.user_id is null then 1 else 0 end)"),
+    Check('songplays_orphan_time',  _songplays_joined, "sum(case when t.start_time is null then 1 else 0 end)"),
+]
+
+
+def select_checks(names=None, checks=DEFAULT_CHECKS):
+    """This function returns the checks named in 'names' (e.g. the CHECKS
+    list of the [QUALITY] section), all of them when names is empty
+    """
+    if not names:
+        return list(checks)
+    by_name = {check.name: check for check in checks}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError("unknown quality check(s) : {}".format(", ".join(unknown)))
+    return [by_name[name] for name in names]
+
+
+def copy_stats(cur):
+    """This function returns the statistics of the last COPY of the session,
+    read from metadata only : rows loaded, files and lines scanned
+    """
+    cur.execute("select pg_last_copy_id(), pg_last_copy_count()")
+    query_id, rows = cur.fetchone()
+    cur.execute("select count(*), sum(lines_scanned) from stl_load_commits where query = %s", (query_id,))
+    files, lines = cur.fetchone()
+    return {'query_id' : query_id,
+            'rows'     : rows,
+            'files'    : files,
+            'lines'    : lines or 0}
+
+
+def previous_values(cur, run_id):
+    """Returns check name -> value of the latest earlier run"""
+    cur.execute("""select check_name, value
+                     from etl_quality_results
+                    where run_id = (select max(run_id) from etl_quality_results where run_id < %s)""", (run_id,))
+    return dict(cur.fetchall())
+
+
+def check_queries(checks):
+    """This function groups 'checks' by source and returns a list of
+    (query, checks it evaluates), one query per distinct source
+    """
+    by_source = {}
+    for check in checks:
+        by_source.setdefault(check.source, []).append(check)
+    return [("select {} from {}".format(", ".join(check.expression for check in source_checks), source), source_checks)
+            for source, source_checks in by_source.items()]
+
+
+def run_checks(cur, checks, run_id):
+    """This function evaluates 'checks' with one query per distinct source,
+    compares them with the previous run, records the results in
+    etl_quality_results under 'run_id' and returns the list of CheckResults
+    """
+    previous = previous_values(cur, run_id)
+    results = []
+    for query, source_checks in check_queries(checks):
+        cur.execute(query)
+        for check, value in zip(source_checks, cur.fetchone()):
+            value = int(value) if value is not None else None
+            results.append(CheckResult(check, value, previous.get(check.name)))
+
+    cur.execute("delete from etl_quality_results where run_id = %s", (run_id,))
+    if results:
+        recorded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        values = [(run_id, result.name, result.value, result.passed, result.detail or None, recorded_at)
+                  for result in results]
+        cur.execute("""INSERT INTO etl_quality_results (run_id, check_name, value, passed, detail, recorded_at)
+                       VALUES {}""".format(", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(values))),
+                    [field for row in values for field in row])
+    return results
+
+
+def report(results):
+    """This function prints one JSON line per result and returns the failed ones"""
+    for result in results:
+        print(json.dumps(result.as_dict()))
+    return [result for result in results if not result.passed]
@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class SqlTemplate(str):
+    """A catalog statement with run-time placeholders, e.g. '{role_arn}'.
+    It is still the template text (so it can be listed, named and tested
+    offline) and only becomes executable SQL through render(context).
+    """
+
+    def render(self, context):
+        return self.format_map(context)
+
+
+_role_arn_cache = {}
+_role_arn_lock = threading.Lock()
+
+
+def resolve_role_arn(config, ttl_seconds=3600):
+    """This function returns the ARN of the IAM role named in dwh.cfg.
+    The IAM lookup is done once and cached for 'ttl_seconds'; lookup
+    errors are raised instead of producing an empty ARN.
+    """
+    role_name = config.get('IAM_ROLE', 'IAM_ROLE_NAME')
+    with _role_arn_lock:
+        cached = _role_arn_cache.get(role_name)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        import boto3
+        iam = boto3.client('iam', aws_access_key_id=config.get('AWS','KEY'),
+                           aws_secret_access_key=config.get('AWS','SECRET'),
+                           region_name='us-west-2')
+        arn = iam.get_role(RoleName=role_name)['Role']['Arn']
+        _role_arn_cache[role_name] = (arn, time.monotonic() + ttl_seconds)
+        return arn
+
+
+class RunContext:
+    """Values SqlTemplates are rendered with, resolved only when a template
+    actually uses them :
+        role_arn      - given, or looked up (and cached) by resolve_role_arn
+        log_data, log_jsonpath, song_data, preprocessed - [S3] section of dwh.cfg
+        any extra keyword values, e.g. manifest_url
+    """
+
+    S3_KEYS = {'log_data'     : 'LOG_DATA',
+               'log_jsonpath' : 'LOG_JSONPATH',
+               'song_data'    : 'SONG_DATA',
+               'preprocessed' : 'PREPROCESSED_PREFIX'}
+
+    def __init__(self, config, role_arn=None, **values):
+        self._config = config
+        self._values = dict(values)
+        if role_arn:
+            self._values['role_arn'] = role_arn
+
+    def with_values(self, **values):
+        """Returns a copy of the context with extra or overridden values"""
+        context = RunContext(self._config, **self._values)
+        context._values.update(values)
+        return context
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key == 'role_arn':
+            return resolve_role_arn(self._config,
+                                    self._config.getint('IAM_ROLE', 'ARN_TTL_SECONDS', fallback=3600))
+        if key in self.S3_KEYS:
+            value = self._config.get('S3', self.S3_KEYS[key])
+            return value.rstrip('/') if key == 'preprocessed' else value
+        raise KeyError(key)
+
+
+def render(query, context):
+    """This function renders a SqlTemplate with 'context'; plain statements
+    are returned unchanged
+    """
+    return query.render(context) if isinstance(query, SqlTemplate) else query
+
+
+class ContextCursor:
+    """Cursor wrapper rendering SqlTemplates with a RunContext on execute()"""
+
+    def __init__(self, cursor, context):
+        self._cursor = cursor
+        self._context = context
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def execute(self, query, vars=None):
+        self._cursor.execute(render(query, self._context), vars)
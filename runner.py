@@ -0,0 +1,340 @@
+import argparse
+import asyncio
+import configparser
+import importlib.util
+import os
+import time
+
+from aggregates import ensure_rollups, rollups
+from connection_pool import ConnectionPool, pool_from_config
+from instrument import InstrumentedCursor, RunMetrics
+from ledger import WHOLE_LOAD, RunLedger
+from migrations import migrate
+from plans import estimate, parse_plan
+from quality import check_queries, select_checks
+from run_context import ContextCursor, RunContext, render
+from schema import star_schema
+from sql_queries import query_names, create_table_queries, truncate_staging_queries, staging_copy_feeds, process_table_graph, process_table_chains, partitioned_chains
+
+
+# Single entry point for operators : runs any selection of the pipeline
+# stages, in pipeline order, against the Redshift cluster of dwh.cfg or a
+# local PostgreSQL (statements shimmed as in the benchmark). The merge stage
+# can be limited to some chains, e.g. only songplay_table after a fix, and
+# --dry-run prints the SQL each stage would run without executing it.
+# Stages run one after the other on the event loop; blocking database work
+# runs in worker threads and the merge chains keep their own parallelism.
+# The merge stage goes through etl.merge_tables(), as the nightly etl run
+# does (dimension cache, WLM profiles & maintenance).
+
+STAGES = ['provision', 'schema', 'copy', 'merge', 'aggregates', 'quality']
+# provisioning creates AWS resources and only runs when asked for
+DEFAULT_STAGES = ['schema', 'copy', 'merge', 'aggregates', 'quality']
+# the rollups refresh is its own 'aggregates' stage
+MERGE_CHAINS = [name for name in process_table_chains if name != 'aggregate_table']
+LEDGER_STAGES = ('copy', 'merge', 'aggregates', 'quality')
+
+
+def select_stages(stages=None, chains=None):
+    """This function returns the stages to run, in pipeline order : the
+    given ones, only 'merge' when just chains are given, the default
+    stages otherwise
+    """
+    if not stages:
+        return ['merge'] if chains else list(DEFAULT_STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError("unknown stage(s) : {}".format(", ".join(unknown)))
+    return [stage for stage in STAGES if stage in stages]
+
+
+def select_chains(chains=None):
+    """Returns the merge chains to run, all of them by default, in graph order"""
+    if not chains:
+        return list(MERGE_CHAINS)
+    unknown = [chain for chain in chains if chain not in MERGE_CHAINS]
+    if unknown:
+        raise ValueError("unknown merge chain(s) : {}".format(", ".join(unknown)))
+    return [chain for chain in MERGE_CHAINS if chain in chains]
+
+
+def chain_graph(chains):
+    """Returns process_table_graph limited to 'chains'; dependencies on
+    chains left out are assumed to be done already
+    """
+    return {name: [dep for dep in deps if dep in chains] for name, deps in process_table_graph.items() if name in chains}
+
+
+def etl_module():
+    """The etl entry point lives in 'etl (1).py', a file name that cannot be
+    imported by name; it is loaded from its path to reuse its load steps
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etl (1).py')
+    spec = importlib.util.spec_from_file_location('etl', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def aws_client(config, service, resource=False):
+    import boto3
+    factory = boto3.resource if resource else boto3.client
+    return factory(service,
+                   region_name="us-west-2",
+                   aws_access_key_id=config.get('AWS','KEY'),
+                   aws_secret_access_key=config.get('AWS','SECRET'))
+
+
+def cluster_endpoint(config):
+    """Returns (role ARN, endpoint address) of the cluster of dwh.cfg"""
+    cluster = aws_client(config, 'redshift').describe_clusters(
+        ClusterIdentifier=config.get("CLUSTER","CLS_IDENTIFIER"))['Clusters'][0]
+    return cluster['IamRoles'][0]['IamRoleArn'], cluster['Endpoint']['Address']
+
+
+# DRY RUN
+
+def stage_statements(stage, context, chains, target='redshift', check_names=None, copy_feeds=None):
+    """This function returns the statements 'stage' would run, as a list of
+    (label, SQL) rendered with 'context'. Partitioned chains are rendered
+    with the '<day>' placeholders of one partition, and the COPYs are those
+    of 'copy_feeds' (feed -> template, see staging_copy_feeds), with a
+    '<manifest_url>' placeholder for the manifest a load writes.
+    """
+    if stage == 'provision':
+        return []
+    if stage == 'schema':
+        statements = [(query_names.get(query), query) for query in create_table_queries]
+        return statements + [('create_' + rollup.name, rollup.create_sql()) for rollup in rollups]
+    if stage == 'copy':
+        if target == 'local':
+            return [(feed, "COPY {} FROM STDIN WITH (FORMAT csv) -- preprocessed {} chunks".format(table, feed))
+                    for feed, table in (('log_data', 'stg_events'), ('song_data', 'stg_songs'))]
+        copy_context = context.with_values(manifest_url='<manifest_url>')
+        return ([(query_names.get(query), query) for query in truncate_staging_queries] +
+                [(query_names.get(template), render(template, copy_context))
+                 for template in (copy_feeds or staging_copy_feeds()).values()])
+    if stage in ('merge', 'aggregates'):
+        statements = []
+        for chain in (chains if stage == 'merge' else ['aggregate_table']):
+            chain_context = context
+            if chain in partitioned_chains:
+                chain_context = context.with_values(partition_start='<day>', partition_end='<day + 1>')
+            statements.extend(("{}.{}".format(chain, query_names.get(query)), render(query, chain_context))
+                              for query in process_table_chains[chain])
+        return statements
+    if stage == 'quality':
+        return [(", ".join(check.name for check in checks), query)
+                for query, checks in check_queries(select_checks(check_names))]
+    raise ValueError("unknown stage '{}'".format(stage))
+
+
+def print_dry_run(stages, config, context, chains, target, check_names=None, pool=None):
+    """This function prints, per stage, the SQL it would run and the amount
+    of work : statement count and, with a 'pool' to plan against, the
+    migration steps and the EXPLAIN cost & rows of the SELECT of every
+    merge statement (plans.estimate; nothing is executed)
+    """
+    for stage in stages:
+        load_format = config.get("ETL", "LOAD_FORMAT", fallback="json")
+        load_mode = config.get("ETL", "LOAD_MODE", fallback="full")
+        statements = stage_statements(stage, context, chains, target, check_names,
+                                      staging_copy_feeds(load_format, load_mode))
+        print("== {} : {} statement(s)".format(stage, len(statements)))
+        if stage == 'copy' and target == 'redshift':
+            print("-- LOAD_FORMAT {}, LOAD_MODE {}".format(load_format, load_mode))
+        if stage == 'provision':
+            print("-- role {} & cluster {}".format(config.get("IAM_ROLE", "IAM_ROLE_NAME"),
+                                                   config.get("CLUSTER", "CLS_IDENTIFIER")))
+        for label, sql in statements:
+            print("-- {}\n{};".format(label, "\n".join(line.rstrip() for line in sql.strip().rstrip(';').splitlines())))
+        if pool is None:
+            continue
+        if stage == 'schema':
+            steps = migrate(pool, star_schema, redshift=target == 'redshift', dry_run=True)
+            print("-- schema migration : {} step(s)".format(len(steps)))
+        if stage in ('merge', 'aggregates'):
+            selected = {chain: process_table_chains[chain]
+                        for chain in (chains if stage == 'merge' else ['aggregate_table'])}
+            estimates = estimate(pool, context, selected, partitioned_chains)
+            print("-- estimates for partition {}".format(estimates['partition']))
+            for name, entry in estimates['statements'].items():
+                if 'plan' in entry:
+                    summary = parse_plan(entry['plan']).summary()
+                    print("-- {:<32} cost {:>14.2f} rows {:>10}".format(name, summary['cost'] or 0,
+                                                                         summary['rows'] or 0))
+                else:
+                    print("-- {:<32} not explained : {}".format(name, entry['error']))
+
+
+# RUN
+
+async def run_stage(stage, func, *args):
+    start = time.perf_counter()
+    result = await asyncio.to_thread(func, *args)
+    print("{:<12} {:>8.2f}s".format(stage, time.perf_counter() - start))
+    return result
+
+
+def load_local(pool, data_dir, work_dir, num_chunks):
+    """This function loads the local feeds of 'data_dir' (log_data/,
+    song_data/) into the staging tables the way the benchmark does
+    """
+    from benchmark import load_local as copy_chunks
+    from preprocess import preprocess_feed
+    chunks = {}
+    for feed in ('log_data', 'song_data'):
+        paths, rows = preprocess_feed(feed, os.path.join(data_dir, feed), os.path.join(work_dir, feed), num_chunks)
+        print("{} : {} rows in {} chunk(s)".format(feed, rows, len(paths)))
+        chunks[feed] = paths
+    copy_chunks(pool, chunks)
+
+
+def create_rollups(pool, redshift=True):
+    with pool.transaction() as cur:
+        print("Rollups created : {}".format(", ".join(ensure_rollups(cur, redshift)) or "none"))
+
+
+async def run_pipeline(args, config, stages, chains):
+    """This function runs 'stages' in order. The pool is opened once the
+    cluster is known (after 'provision' when it runs), and a run ledger is
+    started for the stages that record their progress. Merging some chains
+    (--chain) is refused while the latest run is unfinished, unless resumed.
+    The run is closed, and its files marked ingested, only once the staging
+    load and every merge chain are checkpointed for it; otherwise it is left
+    open for the etl or --resume to finish.
+    """
+    redshift = args.target == 'redshift'
+    role_arn = host = None
+    if 'provision' in stages:
+        from provisioning import provision
+        start = time.perf_counter()
+        role_arn, host = await provision(config, aws_client(config, 'iam'), aws_client(config, 'redshift'),
+                                         aws_client(config, 'ec2', resource=True))
+        print("{:<12} {:>8.2f}s".format('provision', time.perf_counter() - start))
+        stages = [stage for stage in stages if stage != 'provision']
+        if not stages:
+            return
+    if redshift and host is None:
+        role_arn, host = await asyncio.to_thread(cluster_endpoint, config)
+
+    metrics = RunMetrics('runner', config.get("ETL", "METRICS_DIR", fallback="metrics"))
+    maxconn = max(args.parallel, 2)
+    if redshift:
+        context = RunContext(config, role_arn=role_arn)
+        query_ids = config.getboolean("ETL", "QUERY_IDS", fallback=True)
+        pool = pool_from_config(config, host, maxconn=maxconn,
+                                wrap_cursor=lambda cur: InstrumentedCursor(ContextCursor(cur, context), metrics,
+                                                                           query_names, query_ids))
+    else:
+        from benchmark import ShimCursor
+        context = RunContext(None)
+        pool = ConnectionPool(args.dsn, maxconn=maxconn,
+                              wrap_cursor=lambda cur: InstrumentedCursor(ShimCursor(cur), metrics, query_names,
+                                                                         query_ids=False))
+    etl = etl_module()
+    wlm = redshift and config.getboolean("ETL", "WLM", fallback=True)
+    try:
+        if 'schema' in stages:
+            await run_stage('schema', migrate, pool, star_schema, redshift)
+            await run_stage('rollups', create_rollups, pool, redshift)
+
+        ledger = None
+        if any(stage in LEDGER_STAGES for stage in stages):
+            ledger = RunLedger(pool, resume=args.resume)
+            unfinished = await asyncio.to_thread(ledger.unfinished)
+            if args.chains and not args.resume and unfinished:
+                raise RuntimeError("run {} is unfinished : resume it with --resume, or let the etl finish it, "
+                                   "before merging single chains".format(unfinished))
+            await asyncio.to_thread(ledger.start)
+
+        if 'copy' in stages:
+            if ledger.done(WHOLE_LOAD, 'load'):
+                print("staging tables already loaded by run {}".format(ledger.run_id))
+            elif redshift:
+                await run_stage('copy', etl.load_from_config, pool, context, aws_client(config, 's3'), config,
+                                ledger)
+            else:
+                await run_stage('copy', load_local, pool, args.data, os.path.join(args.workdir, 'chunks'),
+                                args.parallel)
+                ledger.record(WHOLE_LOAD, 'load')
+
+        # the local target keeps its dimension digests apart from the cluster's
+        dim_cache_db = None if redshift else os.path.join(args.workdir, 'dim_cache.db')
+
+        def merge(graph):
+            etl.merge_tables(pool, ledger, context, config, graph, args.parallel, wlm, dim_cache_db)
+
+        if 'merge' in stages:
+            await run_stage('calendar', etl.refresh_calendar, pool)
+            await run_stage('merge', merge, chain_graph(chains))
+        if 'aggregates' in stages:
+            await run_stage('aggregates', merge, chain_graph(['aggregate_table']))
+        failed = []
+        if 'quality' in stages:
+            failed = await run_stage('quality', etl.check_quality, pool, ledger.run_id, args.checks)
+        if ledger:
+            complete = await asyncio.to_thread(ledger.complete, process_table_graph, partitioned_chains)
+            await asyncio.to_thread(etl.finish_run, config, ledger, failed,
+                                    config.getboolean("QUALITY", "FAIL", fallback=True), redshift, complete)
+    finally:
+        pool.closeall()
+        metrics.print_summary()
+        print("metrics written to {}".format(metrics.write()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run selected stages of the Sparkify pipeline")
+    parser.add_argument('--stages', help="comma separated, in any order, from : {} (default : {})".format(
+        ", ".join(STAGES), ", ".join(DEFAULT_STAGES)))
+    parser.add_argument('--chain', action='append', dest='chains', choices=MERGE_CHAINS,
+                        help="merge only this chain (repeatable); alone, runs only the merge stage")
+    parser.add_argument('--parallel', type=int, default=4, help="chains merged at the same time")
+    parser.add_argument('--dry-run', action='store_true', help="print the SQL of the stages, run nothing")
+    parser.add_argument('--estimate', action='store_true',
+                        help="with --dry-run, connect to plan the schema migration & EXPLAIN the merges")
+    parser.add_argument('--target', choices=['redshift', 'local'], default='redshift')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DSN', 'host=localhost dbname=postgres user=postgres'),
+                        help="local target connection")
+    parser.add_argument('--data', default='data', help="local target : directory holding log_data/ & song_data/")
+    parser.add_argument('--workdir', default='runner_work', help="local target : preprocessed chunks")
+    parser.add_argument('--checks', help="comma separated quality checks (default : CHECKS of [QUALITY])")
+    parser.add_argument('--resume', action='store_true', help="resume the last unfinished run of the ledger")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    checks = args.checks if args.checks is not None else config.get("QUALITY", "CHECKS", fallback="")
+    args.checks = [name.strip() for name in checks.split(",") if name.strip()]
+    try:
+        stages = select_stages([stage.strip() for stage in args.stages.split(",")] if args.stages else None,
+                               args.chains)
+        chains = select_chains(args.chains)
+        select_checks(args.checks)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.target == 'local' and 'provision' in stages:
+        parser.error("the local target cannot be provisioned")
+
+    if args.dry_run:
+        redshift = args.target == 'redshift'
+        pool = None
+        if args.estimate:
+            if redshift:
+                pool = pool_from_config(config, cluster_endpoint(config)[1])
+            else:
+                from benchmark import ShimCursor
+                pool = ConnectionPool(args.dsn, wrap_cursor=ShimCursor)
+        try:
+            print_dry_run(stages, config, RunContext(config if redshift else None, role_arn='<role_arn>'), chains,
+                          args.target, args.checks, pool)
+        finally:
+            if pool:
+                pool.closeall()
+        return
+
+    asyncio.run(run_pipeline(args, config, stages, chains))
+
+
+if __name__ == "__main__":
+    main()
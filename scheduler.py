@@ -0,0 +1,86 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def topological_order(graph):
+    """This function validates a dependency graph and returns its node names
+    in an order where every node comes after all of its dependencies.
+        graph - dict of node name -> list of node names it depends on
+    Raises ValueError for unknown dependencies or cycles.
+    """
+    for node, deps in graph.items():
+        for dep in deps:
+            if dep not in graph:
+                raise ValueError("node '{}' depends on unknown node '{}'".format(node, dep))
+
+    order, done, visiting = [], set(), set()
+
+    def visit(node):
+        if node in done:
+            return
+        if node in visiting:
+            raise ValueError("dependency cycle detected at node '{}'".format(node))
+        visiting.add(node)
+        for dep in graph[node]:
+            visit(dep)
+        visiting.discard(node)
+        done.add(node)
+        order.append(node)
+
+    for node in graph:
+        visit(node)
+    return order
+
+
+def run_dag(graph, run_node, max_workers=4):
+    """This function runs every node of a dependency graph, starting each node
+    as soon as all of its dependencies have finished. Independent nodes run
+    at the same time on a pool of worker threads.
+        graph       - dict of node name -> list of node names it depends on
+        run_node    - callable taking a node name, does the actual work
+        max_workers - number of nodes allowed to run concurrently
+    Returns dict of node name -> wall time in seconds.
+    If a node fails, no new nodes are started and the first error is raised
+    once the nodes already running have finished.
+    """
+    topological_order(graph)
+
+    pending = {node: set(deps) for node, deps in graph.items()}
+    timings = {}
+    running = {}
+    error = None
+
+    def timed(node):
+        start = time.perf_counter()
+        run_node(node)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                ready = [node for node, deps in pending.items() if not deps]
+                for node in ready:
+                    del pending[node]
+                    print("Starting {}".format(node))
+                    running[executor.submit(timed, node)] = node
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    timings[node] = future.result()
+                except Exception as e:
+                    print("{} failed : {}".format(node, e))
+                    if error is None:
+                        error = e
+                    continue
+                print("{} complete in {:.2f}s".format(node, timings[node]))
+                for deps in pending.values():
+                    deps.discard(node)
+
+    if error is not None:
+        raise error
+    return timings
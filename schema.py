@@ -0,0 +1,288 @@
+import math
+
+
+class Column:
+    """One column of a table spec.
+        name     - column name
+        type     - Redshift type, e.g. 'varchar(64)', 'int', 'timestamp'
+        encode   - compression encoding (ENCODE clause), None for the default
+        nullable - False adds NOT NULL
+        extra    - anything else rendered after the type, e.g. 'IDENTITY(0,1)'
+    """
+
+    def __init__(self, name, type, encode=None, nullable=True, extra=None):
+        self.name = name
+        self.type = type
+        self.encode = encode
+        self.nullable = nullable
+        self.extra = extra
+
+    def render(self):
+        parts = [self.name, self.type]
+        if self.extra:
+            parts.append(self.extra)
+        if not self.nullable:
+            parts.append("NOT NULL")
+        if self.encode:
+            parts.append("ENCODE {}".format(self.encode))
+        return " ".join(parts)
+
+
+class TableSpec:
+    """Physical design of one table.
+        diststyle   - 'KEY', 'ALL', 'EVEN' or 'AUTO'
+        distkey     - distribution column, required with diststyle 'KEY'
+        sortkey     - list of columns of the compound sort key
+        constraints - table constraints rendered as is, e.g. 'PRIMARY KEY (user_id)'
+    """
+
+    def __init__(self, name, columns, diststyle='AUTO', distkey=None, sortkey=(), constraints=()):
+        self.name = name
+        self.columns = list(columns)
+        self.diststyle = diststyle.upper()
+        self.distkey = distkey
+        self.sortkey = list(sortkey)
+        self.constraints = list(constraints)
+        names = [column.name for column in self.columns]
+        if self.diststyle == 'KEY' and distkey not in names:
+            raise ValueError("{} : diststyle KEY needs a distkey column".format(name))
+        for column in self.sortkey:
+            if column not in names:
+                raise ValueError("{} : unknown sortkey column '{}'".format(name, column))
+
+    def column(self, name):
+        for column in self.columns:
+            if column.name == name:
+                return column
+        raise KeyError(name)
+
+
+def create_table_sql(spec):
+    """This function renders the CREATE TABLE statement of a TableSpec"""
+    body = ",\n     ".join([column.render() for column in spec.columns] + spec.constraints)
+    sql = "CREATE TABLE IF NOT EXISTS {}\n    ({}\n    )\n    DISTSTYLE {}".format(spec.name, body, spec.diststyle)
+    if spec.diststyle == 'KEY':
+        sql += "\n    DISTKEY ({})".format(spec.distkey)
+    if spec.sortkey:
+        sql += "\n    COMPOUND SORTKEY ({})".format(", ".join(spec.sortkey))
+    return sql
+
+
+# STAR SCHEMA
+# Staging widths are generous so COPY never truncates; target widths are
+# sized to the Sparkify feeds. The leading sort key column is left RAW,
+# numeric & time columns use AZ64, low-cardinality text BYTEDICT and other
+# text ZSTD. songplays is spread on user_id, songs on song_id; the small
+# artists & users dimensions are copied to every node.
+
+stg_events_spec = TableSpec('stg_events', [
+    Column('artist_name',   'varchar(512)', 'zstd'),
+    Column('ev_auth',       'varchar(16)',  'bytedict'),
+    Column('first_name',    'varchar(128)', 'zstd'),
+    Column('gender',        'char(1)',      'bytedict'),
+    Column('iteminsession', 'int',          'az64'),
+    Column('last_name',     'varchar(128)', 'zstd'),
+    Column('ev_length',     'numeric(10,5)', 'az64'),
+    Column('level',         'varchar(8)',   'bytedict'),
+    Column('location',      'varchar(256)', 'zstd'),
+    Column('method',        'varchar(8)',   'bytedict'),
+    Column('page',          'varchar(32)',  'bytedict'),
+    Column('registration',  'numeric(18,1)', 'az64'),
+    Column('sessionid',     'int',          'az64'),
+    Column('song_title',    'varchar(512)', 'zstd'),
+    Column('status',        'int',          'az64'),
+    Column('ts',            'timestamp',    'raw'),
+    Column('useragent',     'varchar(512)', 'zstd'),
+    Column('userid',        'int',          'az64'),
+], diststyle='EVEN', sortkey=['ts'])
+
+stg_songs_spec = TableSpec('stg_songs', [
+    Column('song_id',          'varchar(32)',   'zstd'),
+    Column('num_songs',        'int',           'az64'),
+    Column('title',            'varchar(512)',  'zstd'),
+    Column('artist_name',      'varchar(512)',  'zstd'),
+    Column('artist_latitude',  'numeric(9,5)',  'az64'),
+    Column('year',             'int',           'az64'),
+    Column('duration',         'numeric(10,5)', 'az64'),
+    Column('artist_id',        'varchar(32)',   'zstd'),
+    Column('artist_longitude', 'numeric(9,5)',  'az64'),
+    Column('artist_location',  'varchar(512)',  'zstd'),
+], diststyle='KEY', distkey='song_id')
+
+# distributed on user_id : plays per song follow a Zipf curve (a few hits hold
+# most rows, unmatched plays all have a null song_id) and would pile up on one
+# slice, while plays per user stay even and users is DISTSTYLE ALL anyway
+songplays_spec = TableSpec('songplays', [
+    Column('songplay_id', 'bigint',       'az64', nullable=False, extra='IDENTITY(0,1)'),
+    Column('start_time',  'timestamp',    'raw',  nullable=False),
+    Column('user_id',     'int',          'az64', nullable=False),
+    Column('level',       'varchar(8)',   'bytedict'),
+    Column('song_id',     'varchar(32)',  'zstd'),
+    Column('artist_id',   'varchar(32)',  'zstd'),
+    Column('session_id',  'int',          'az64', nullable=False),
+    Column('location',    'varchar(256)', 'zstd'),
+    Column('user_agent',  'varchar(512)', 'zstd'),
+], diststyle='KEY', distkey='user_id', sortkey=['start_time', 'user_id'],
+   constraints=['CONSTRAINT pk_tmusrses_id UNIQUE (start_time, user_id, session_id)'])
+
+users_spec = TableSpec('users', [
+    Column('user_id',    'int',          'raw', nullable=False),
+    Column('first_name', 'varchar(128)', 'zstd'),
+    Column('last_name',  'varchar(128)', 'zstd'),
+    Column('gender',     'char(1)',      'bytedict'),
+    Column('level',      'varchar(8)',   'bytedict'),
+], diststyle='ALL', sortkey=['user_id'], constraints=['PRIMARY KEY (user_id)'])
+
+songs_spec = TableSpec('songs', [
+    Column('song_id',   'varchar(32)',   'raw', nullable=False),
+    Column('title',     'varchar(512)',  'zstd'),
+    Column('artist_id', 'varchar(32)',   'zstd'),
+    Column('year',      'int',           'az64'),
+    Column('duration',  'numeric(10,5)', 'az64'),
+], diststyle='KEY', distkey='song_id', sortkey=['song_id'], constraints=['PRIMARY KEY (song_id)'])
+
+artists_spec = TableSpec('artists', [
+    Column('artist_id',   'varchar(32)',  'raw', nullable=False),
+    Column('artist_name', 'varchar(512)', 'zstd'),
+    Column('location',    'varchar(512)', 'zstd'),
+    Column('latitude',    'numeric(9,5)', 'az64'),
+    Column('longitude',   'numeric(9,5)', 'az64'),
+], diststyle='ALL', sortkey=['artist_id'], constraints=['PRIMARY KEY (artist_id)'])
+
+time_spec = TableSpec('time', [
+    Column('start_time', 'timestamp', 'raw', nullable=False),
+    Column('hour',       'smallint',  'az64'),
+    Column('day',        'smallint',  'az64'),
+    Column('week',       'smallint',  'az64'),
+    Column('month',      'smallint',  'az64'),
+    Column('year',       'smallint',  'az64'),
+    Column('weekday',    'smallint',  'az64'),
+], diststyle='KEY', distkey='start_time', sortkey=['start_time'], constraints=['PRIMARY KEY (start_time)'])
+
+# lookup of songs by the normalized (title, artist, duration) key of song_match.py
+song_match_spec = TableSpec('song_match', [
+    Column('match_key', 'char(32)',    'raw', nullable=False),
+    Column('song_id',   'varchar(32)', 'zstd'),
+    Column('artist_id', 'varchar(32)', 'zstd'),
+], diststyle='KEY', distkey='match_key', sortkey=['match_key'], constraints=['PRIMARY KEY (match_key)'])
+
+# one row per hour, generated once by calendar_hours.py and reused by every run to
+# expand start_time into the time dimension attributes
+calendar_hours_spec = TableSpec('calendar_hours', [
+    Column('hour_start', 'timestamp', 'raw', nullable=False),
+    Column('hour',       'smallint',  'az64'),
+    Column('day',        'smallint',  'az64'),
+    Column('week',       'smallint',  'az64'),
+    Column('month',      'smallint',  'az64'),
+    Column('year',       'smallint',  'az64'),
+    Column('weekday',    'smallint',  'az64'),
+], diststyle='ALL', sortkey=['hour_start'], constraints=['PRIMARY KEY (hour_start)'])
+
+# one row per completed step of an etl run (see ledger.py); partition_key is
+# the ts date of the events a step covered, '-' for whole-load steps
+run_ledger_spec = TableSpec('etl_run_ledger', [
+    Column('run_id',        'varchar(32)', 'raw', nullable=False),
+    Column('partition_key', 'varchar(32)', 'zstd', nullable=False),
+    Column('step',          'varchar(64)', 'zstd', nullable=False),
+    Column('status',        'varchar(16)', 'bytedict', nullable=False),
+    Column('recorded_at',   'timestamp',   'az64', nullable=False),
+], diststyle='ALL', sortkey=['run_id'])
+
+# one row per data-quality check per etl run (see quality.py)
+quality_results_spec = TableSpec('etl_quality_results', [
+    Column('run_id',      'varchar(32)', 'raw', nullable=False),
+    Column('check_name',  'varchar(64)', 'zstd', nullable=False),
+    Column('value',       'bigint',      'az64'),
+    Column('passed',      'boolean',     'raw'),
+    Column('detail',      'varchar(256)', 'zstd'),
+    Column('recorded_at', 'timestamp',   'az64', nullable=False),
+], diststyle='ALL', sortkey=['run_id'])
+
+# dimension keys new or changed since the last run (see dimcache.py)
+stg_changed_keys_spec = TableSpec('stg_changed_keys', [
+    Column('dimension', 'varchar(32)', 'raw', nullable=False),
+    Column('key_value', 'varchar(64)', 'zstd', nullable=False),
+], diststyle='ALL', sortkey=['dimension', 'key_value'])
+
+# NextSong events of the load, deduplicated and already cast to the target
+# columns, with the song_match key precomputed (see sql_queries.py); the
+# users, time & songplays merges read it instead of stg_events. Sorted on
+# start_time for the day partitions and, like songplays, distributed on
+# user_id : on match_key the Zipf curve of plays per song would pile the
+# rows of each day on a few slices. The song_match join redistributes a day
+# of plays instead, and the rows it builds already sit on the slice of
+# their songplays rows.
+stg_plays_spec = TableSpec('stg_plays', [
+    Column('start_time', 'timestamp',    'raw', nullable=False),
+    Column('user_id',    'int',          'az64', nullable=False),
+    Column('first_name', 'varchar(128)', 'zstd'),
+    Column('last_name',  'varchar(128)', 'zstd'),
+    Column('gender',     'char(1)',      'bytedict'),
+    Column('level',      'varchar(8)',   'bytedict'),
+    Column('session_id', 'int',          'az64'),
+    Column('location',   'varchar(256)', 'zstd'),
+    Column('user_agent', 'varchar(512)', 'zstd'),
+    Column('match_key',  'char(32)',     'zstd'),
+], diststyle='KEY', distkey='user_id', sortkey=['start_time'])
+
+star_schema = [stg_events_spec, stg_songs_spec, songplays_spec, users_spec, songs_spec, artists_spec, time_spec, song_match_spec, calendar_hours_spec, run_ledger_spec, quality_results_spec, stg_changed_keys_spec, stg_plays_spec]
+
+
+# ADVISOR
+
+NUMERIC_TYPES = ('int', 'smallint', 'bigint', 'numeric', 'decimal', 'float', 'double', 'real', 'timestamp', 'date')
+
+
+def _varchar_width(max_length):
+    """Next power of two with 25% headroom over the longest sampled value"""
+    return max(16, 2 ** math.ceil(math.log2(max(1, max_length) * 1.25)))
+
+
+def advise(spec, rows, join_columns=(), dict_threshold=256):
+    """This function recommends physical settings for a table from sample rows.
+        rows         - sample of the table (or of the staging data feeding it)
+                       as a list of dicts, column name -> value
+        join_columns - columns the table is joined on; the one with most
+                       distinct values and least skew is advised as distkey
+    Returns dict of column name -> {'type', 'encode'} recommendations, plus
+    'distkey' (None when no join column is a good candidate).
+    """
+    advice = {}
+    sample_size = len(rows)
+    for column in spec.columns:
+        values = [row.get(column.name) for row in rows if row.get(column.name) is not None]
+        distinct = len(set(values))
+        recommended = {'type': column.type, 'encode': column.encode}
+        if column.type.startswith(('varchar', 'char')):
+            longest = max((len(str(value).encode('utf-8')) for value in values), default=0)
+            if column.type.startswith('varchar'):
+                recommended['type'] = 'varchar({})'.format(_varchar_width(longest))
+            low_cardinality = distinct <= dict_threshold and distinct <= 0.1 * max(1, len(values))
+            recommended['encode'] = 'bytedict' if distinct and low_cardinality else 'zstd'
+        elif column.type.startswith(NUMERIC_TYPES):
+            recommended['encode'] = 'az64'
+        if spec.sortkey and column.name == spec.sortkey[0]:
+            recommended['encode'] = 'raw'
+        advice[column.name] = recommended
+
+    best, best_score = None, 0.0
+    for name in join_columns:
+        values = [row.get(name) for row in rows if row.get(name) is not None]
+        if not values:
+            continue
+        counts = {}
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+        # distinct ratio, penalised by the share of the most frequent value
+        score = (len(counts) / sample_size) * (1 - max(counts.values()) / len(values))
+        if score > best_score:
+            best, best_score = name, score
+    advice['distkey'] = best
+    return advice
+
+
+def sample_table(cur, table, limit=10000):
+    """This function reads up to 'limit' rows of a table as a list of dicts"""
+    cur.execute("select * from {} limit {}".format(table, int(limit)))
+    names = [description[0] for description in cur.description]
+    return [dict(zip(names, row)) for row in cur.fetchall()]
@@ -0,0 +1,11 @@
+# Songs are matched to play events on a normalized (title, artist name,
+# duration rounded to the second) key, hashed to a fixed-width md5 so the
+# songplays join is an equi-join on one char(32) column.
+
+def match_key_sql(title, artist_name, duration):
+    """This function returns the SQL expression computing the match key from
+    the three given column expressions
+    """
+    return ("md5(lower(trim(coalesce({}, ''))) || '|' || "
+            "lower(trim(coalesce({}, ''))) || '|' || "
+            "coalesce(cast(cast(round({}) as int) as varchar), ''))").format(title, artist_name, duration)
@@ -1,25 +1,17 @@
-import configparser
-import boto3
+from aggregates import rollups
+from dimcache import changed_keys_spec
+from merge_builder import MergeSpec, merge_statements
+from schema import create_table_sql, stg_events_spec, stg_songs_spec, songplays_spec, users_spec, songs_spec, artists_spec, time_spec, song_match_spec, calendar_hours_spec, run_ledger_spec, quality_results_spec, stg_changed_keys_spec, stg_plays_spec
+from song_match import match_key_sql
+from instrument import statement_names
+from profiles import Profile
+from run_context import SqlTemplate
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-
-iam = boto3.client('iam',aws_access_key_id=config.get('AWS','KEY'),
-                    aws_secret_access_key=config.get('AWS','SECRET'),
-                    region_name='us-west-2'
-                  )
-
-try:
-    ROLE_ARN = iam.get_role(RoleName=config.get('IAM_ROLE','IAM_ROLE_NAME'))['Role']['Arn']
-except Exception as e:
-    ROLE_ARN = ''
-    print(e)
-
-S3_LOG_DATA   =config.get("S3","LOG_DATA")
-S3_LOG_JSON   =config.get("S3","LOG_JSONPATH")
-S3_SONG_DATA  =config.get("S3","SONG_DATA")
+# Nothing is read or looked up at import time. Statements depending on the
+# environment (S3 locations, IAM role) are SqlTemplates whose placeholders
+# are filled from a RunContext (run_context.py) when they are executed.
 
 # DROP TABLES
 
@@ -30,295 +22,385 @@ user_table_drop           = "DROP TABLE IF EXISTS users"
 song_table_drop           = "DROP TABLE IF EXISTS songs"
 artist_table_drop         = "DROP TABLE IF EXISTS artists"
 time_table_drop           = "DROP TABLE IF EXISTS time"
-user_stg_table_drop       = "DROP TABLE IF EXISTS users_stg"
-song_stg_table_drop       = "DROP TABLE IF EXISTS songs_stg"
-artist_stg_table_drop     = "DROP TABLE IF EXISTS artists_stg"
-time_stg_table_drop       = "DROP TABLE IF EXISTS time_stg"
-songplay_stg_table_drop   = "DROP TABLE IF EXISTS songplays_stg"
+calendar_table_drop       = "DROP TABLE IF EXISTS calendar_hours"
+song_match_table_drop     = "DROP TABLE IF EXISTS song_match"
+run_ledger_table_drop     = "DROP TABLE IF EXISTS etl_run_ledger"
+quality_table_drop        = "DROP TABLE IF EXISTS etl_quality_results"
+changed_keys_table_drop   = "DROP TABLE IF EXISTS stg_changed_keys"
+plays_table_drop          = "DROP TABLE IF EXISTS stg_plays"
 
-# CREATE TABLES
+# songplays rollups (aggregates.py) depend on songplays and are dropped first
+rollup_drop_queries = [rollup.drop_sql() for rollup in rollups]
 
-staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS stg_events 
-                                        (artist_name   varchar,
-                                         ev_auth       varchar,
-                                         first_name    varchar,
-                                         gender        char(1),
-                                         iteminsession int,
-                                         last_name     varchar,
-                                         ev_length     numeric,
-                                         level         varchar,
-                                         location      varchar,
-                                         method        varchar,
-                                         page          varchar,
-                                         registration  numeric,
-                                         sessionid     int,
-                                         song_title    varchar,
-                                         status        int,
-                                         ts            varchar,
-                                         useragent     varchar,
-                                         userid        int
-                                        )
-""")
-
-staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS stg_songs 
-                                        (song_id           varchar,
-                                         num_songs         int,
-                                         title             varchar,
-                                         artist_name       varchar,
-                                         artist_latitude   decimal,
-                                         year              int,
-                                         duration          decimal,
-                                         artist_id         varchar,
-                                         artist_longitude  decimal,
-                                         artist_location   varchar
-                                         )
-""")
-
-songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays 
-                                        (songplay_id bigint IDENTITY(0,1) NOT NULL distkey,
-                                         start_time timestamp NOT NULL,                             
-                                         user_id int NOT NULL,                                 
-                                         level varchar,                                        
-                                         song_id varchar,                                      
-                                         artist_id varchar,                                    
-                                         session_id varchar NOT NULL,                          
-                                         location varchar,                                     
-                                         user_agent varchar,
-                                         CONSTRAINT pk_tmusrses_id 
-                                         UNIQUE (start_time, user_id, session_id)
-                                        )
-""")
-
-user_table_create = ("""CREATE TABLE IF NOT EXISTS users 
-                                    (user_id int PRIMARY KEY, 
-                                     first_name	varchar, 
-                                     last_name varchar, 
-                                     gender char(1), 
-                                     level varchar
-                                    )
-                                    diststyle all
-""")
-
-song_table_create = ("""CREATE TABLE IF NOT EXISTS songs 
-                                    (song_id varchar PRIMARY KEY, 
-                                     title varchar, 
-                                     artist_id varchar distkey, 
-                                     year int, 
-                                     duration numeric 
-                                    )
-""")
-
-artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists 
-                                      (artist_id varchar PRIMARY KEY distkey, 
-                                       artist_name varchar, 
-                                       location varchar, 
-                                       latitude numeric, 
-                                       longitude numeric
-                                      )
-""")
-
-time_table_create = ("""CREATE TABLE IF NOT EXISTS time 
-                                    (start_time timestamp PRIMARY KEY sortkey distkey, 
-                                     hour int, 
-                                     day int,
-                                     week int, 
-                                     month int, 
-                                     year int, 
-                                     weekday int
-                                    )
-""")
+# CREATE TABLES
+# Rendered from the table specs in schema.py (encodings, sort & dist keys)
+
+staging_events_table_create = create_table_sql(stg_events_spec)
+staging_songs_table_create  = create_table_sql(stg_songs_spec)
+songplay_table_create       = create_table_sql(songplays_spec)
+user_table_create           = create_table_sql(users_spec)
+song_table_create           = create_table_sql(songs_spec)
+artist_table_create         = create_table_sql(artists_spec)
+time_table_create           = create_table_sql(time_spec)
+calendar_table_create       = create_table_sql(calendar_hours_spec)
+song_match_table_create     = create_table_sql(song_match_spec)
+run_ledger_table_create     = create_table_sql(run_ledger_spec)
+quality_table_create        = create_table_sql(quality_results_spec)
+changed_keys_table_create   = create_table_sql(stg_changed_keys_spec)
+plays_table_create          = create_table_sql(stg_plays_spec)
 
 # STAGING TABLES
+# stg_events.ts arrives as epoch milliseconds and is landed as a TIMESTAMP
+# by COPY itself (timeformat 'epochmillisecs'), so no later step re-parses it.
+# It keeps the milliseconds : start_time is truncated to the second when the
+# events are refined, as the keys of time & songplays always have been.
 
-staging_events_copy = ("""
+staging_events_copy = SqlTemplate("""
                             copy stg_events 
-                            from '{}'
-                            iam_role '{}'
-                            json '{}' ;
-                           """).format(S3_LOG_DATA, ROLE_ARN, S3_LOG_JSON)
+                            from '{log_data}'
+                            iam_role '{role_arn}'
+                            json '{log_jsonpath}'
+                            timeformat 'epochmillisecs' ;
+                           """)
 
-staging_songs_copy = ("""
+staging_songs_copy = SqlTemplate("""
                         copy stg_songs 
-                        from '{}'
-                        iam_role '{}'
+                        from '{song_data}'
+                        iam_role '{role_arn}'
                         json 'auto';
-                      """).format(S3_SONG_DATA, ROLE_ARN)
-
-# work TABLES
-song_stg_table_create = ("""CREATE TABLE songs_stg AS 
-                              select distinct song_id, 
-                                 title, 
-                                 artist_id, 
-                                 year, 
-                                 duration 
-                              from stg_songs
-""")
-
-user_stg_table_create = ("""CREATE TABLE users_stg AS 
-                              select distinct userid, 
-                               first_name, 
-                               last_name, 
-                               gender, 
-                               level 
-                              from stg_events
-                              where userid is not null
-""")
-
-artist_stg_table_create = ("""CREATE TABLE artists_stg AS
-                               select distinct artist_id, 
-                                  artist_name, 
-                                  artist_location, 
-                                  artist_latitude, 
-                                  artist_longitude 
-                                from stg_songs
-""")
-
-time_stg_table_create = ("""CREATE TABLE time_stg AS
-                              SELECT START_TIME, 
-                              EXTRACT (HOUR FROM START_TIME) as hour_, 
-                              EXTRACT(DAY FROM START_TIME) as day_, 
-                              EXTRACT(WEEK FROM START_TIME) as week_,
-                              EXTRACT(MONTH FROM START_TIME) as month_, 
-                              EXTRACT(YEAR FROM START_TIME) as year_, 
-                              EXTRACT(WEEKDAY FROM START_TIME) as weekday_
-                          FROM (select DISTINCT TIMESTAMP'epoch' + CAST(ts AS BIGINT)/1000 * INTERVAL '1 SECOND' AS START_TIME 
-                                from stg_events)
-""")
-
-songplay_stg_table_create = ("""CREATE TABLE songplays_stg as
-                                SELECT TIMESTAMP'epoch' + CAST(ts AS BIGINT)/1000 * INTERVAL '1 SECOND' as start_time,
-                                      a.userid, a.level, b.song_id, 
-                                      c.artist_id, a.sessionid, 
-                                      a.location, a.useragent
-                                  from stg_events a
-                                  join songs b on a.song_title = b.title
-                                  join artists c on b.artist_id = c.artist_id
-""")
-
-# FINAL TABLES
-songplay_table_delete = ("""delete from songplays_stg  
-                               using songplays
-                               where songplays_stg.userid = songplays.user_id
-                                 and songplays_stg.song_id = songplays.song_id
-                                 and songplays_stg.start_time = songplays.start_time
-""")                                 
-
-songplay_table_insert = ("""INSERT INTO songplays 
-                                 (start_time,
-                                  user_id,
-                                  level,
-                                  song_id,
-                                  artist_id,
-                                  session_id,
-                                  location,
-                                  user_agent)
-                            SELECT start_time,
-                                  userid,
-                                  level,
-                                  song_id,
-                                  artist_id,
-                                  sessionid,
-                                  location,
-                                  useragent
-                              from songplays_stg
-""")
-
-user_table_update = ("""update users  
-                           set level = users_stg.level
-                         from users_stg 
-                         where users.user_id = users_stg.userid
-""")
-
-user_table_delete = ("""delete from users 
-                         using users_stg 
-                         where users.user_id = users_stg.userid
-""")
-
-user_table_insert = ("""INSERT INTO users 
-                              (user_id,
-                               first_name,
-                               last_name,
-                               gender,
-                               level)
-                        select userid, 
-                               first_name, 
-                               last_name, 
-                               gender, 
-                               level 
-                          from users_stg
-""")
-
-song_table_delete = ("""delete from songs_stg 
-                         using songs 
-                         where songs_stg.song_id = songs.song_id
-""")
-
-song_table_insert = ("""INSERT INTO songs 
-                             (song_id,
-                              title,
-                              artist_id,
-                              year,
-                              duration)
-                        select distinct song_id, 
-                               title, 
-                               artist_id, 
-                               year, 
-                               duration 
-                          from songs_stg
-""")
-
-artist_table_delete = ("""delete from artists_stg
-                           using artists 
-                           where artists_stg.artist_id = artists.artist_id
-""")
-
-
-artist_table_insert = ("""INSERT INTO artists 
-                             (artist_id,
-                              artist_name,
-                              location,
-                              latitude,
-                              longitude)
-                          select distinct artist_id, 
-                              artist_name, 
-                              artist_location, 
-                              artist_latitude, 
-                              artist_longitude 
-                            from artists_stg                           
-""")
-
-time_table_delete = ("""delete from time_stg
-                           using time 
-                           where time_stg.start_time = time.start_time
-""")
-
-time_table_insert = ("""INSERT INTO time 
-                             (start_time,
-                              hour,
-                              day,
-                              week,
-                              month,
-                              year,
-                              weekday)
-                        SELECT start_time,
-                              hour_,
-                              day_,
-                              week_,
-                              month_,
-                              year_,
-                              weekday_
-                          FROM time_stg 
-""")
+                      """)
+
+# Incremental loads : COPY only the files listed in a manifest.
+# The manifest url is given at run time through the 'manifest_url' value.
+staging_events_manifest_copy = SqlTemplate("""
+                            copy stg_events 
+                            from '{manifest_url}'
+                            iam_role '{role_arn}'
+                            json '{log_jsonpath}'
+                            timeformat 'epochmillisecs'
+                            manifest ;
+                           """)
+
+staging_songs_manifest_copy = SqlTemplate("""
+                        copy stg_songs 
+                        from '{manifest_url}'
+                        iam_role '{role_arn}'
+                        json 'auto'
+                        manifest ;
+                      """)
+
+# Pre-processed loads : COPY the gzip CSV / Parquet chunks written by
+# preprocess.py instead of parsing raw JSON.
+staging_events_csv_copy = SqlTemplate("""
+                            copy stg_events 
+                            from '{preprocessed}/log_data/'
+                            iam_role '{role_arn}'
+                            csv gzip
+                            timeformat 'epochmillisecs'
+                            emptyasnull blanksasnull ;
+                           """)
+
+staging_songs_csv_copy = SqlTemplate("""
+                        copy stg_songs 
+                        from '{preprocessed}/song_data/'
+                        iam_role '{role_arn}'
+                        csv gzip
+                        emptyasnull blanksasnull ;
+                      """)
+
+staging_events_parquet_copy = SqlTemplate("""
+                            copy stg_events 
+                            from '{preprocessed}/log_data/'
+                            iam_role '{role_arn}'
+                            format as parquet ;
+                           """)
+
+staging_songs_parquet_copy = SqlTemplate("""
+                        copy stg_songs 
+                        from '{preprocessed}/song_data/'
+                        iam_role '{role_arn}'
+                        format as parquet ;
+                      """)
+
+# Planned loads : COPY the size-balanced gzip files packed by load_planner.py,
+# one per slice, listed in the manifest given through 'manifest_url'.
+staging_events_packed_copy = SqlTemplate("""
+                            copy stg_events 
+                            from '{manifest_url}'
+                            iam_role '{role_arn}'
+                            json '{log_jsonpath}'
+                            timeformat 'epochmillisecs'
+                            gzip manifest ;
+                           """)
+
+staging_songs_packed_copy = SqlTemplate("""
+                        copy stg_songs 
+                        from '{manifest_url}'
+                        iam_role '{role_arn}'
+                        json 'auto'
+                        gzip manifest ;
+                      """)
+
+staging_events_truncate = "TRUNCATE stg_events"
+staging_songs_truncate  = "TRUNCATE stg_songs"
+
+# REFINED EVENTS
+# stg_events is scanned once per load : its NextSong events are deduplicated
+# (an event loaded twice is one play), cast to the target columns and keyed
+# on the song_match key into stg_plays, which the users, time & songplays
+# merges then read one day at a time. start_time is truncated to the second
+# so a reloaded event matches the time & songplays rows already merged.
+# stg_plays is a permanent table (the merges read it on other sessions)
+# emptied with TRUNCATE, which leaves no deleted rows to scan or vacuum and
+# keeps the rows in their sort order, then ANALYZEd so the day-by-day
+# merges are planned on its new content. In Redshift TRUNCATE commits at
+# once : it runs first in the chain, and a run stopped before the
+# refine_events checkpoint refines the events again.
+
+refine_events_truncate = "TRUNCATE stg_plays"
+refine_events_insert = """INSERT INTO stg_plays (start_time, user_id, first_name, last_name, gender, level,
+                                                 session_id, location, user_agent, match_key)
+                          SELECT DISTINCT date_trunc('second', ts), userid, first_name, last_name, gender, level,
+                                 sessionid, location, useragent, {}
+                            FROM stg_events
+                           WHERE page = 'NextSong'
+                             AND ts is not null
+                             AND userid is not null""".format(
+    match_key_sql('song_title', 'artist_name', 'ev_length'))
+refine_events_analyze = "ANALYZE stg_plays"
+
+# MERGES
+# Each target is merged from staging in one pass : incoming rows are staged
+# into a session temp table, then a single MERGE (users, where 'level'
+# changes) or a single insert of new keys (all other tables) is applied.
+# See merge_builder.py.
+#
+# users, time and songplays are driven by the refined events and are merged
+# one day at a time : their sources are SqlTemplates filtered on
+# '{partition_start}' <= start_time < '{partition_end}', given per partition
+# by the run ledger (ledger.py); the insert of new time & songplays keys only
+# looks at the target rows of the same range, so each day does not rescan
+# the whole target. songs, artists and song_match cover the whole load.
+
+
+def _partition_filter(column):
+    return "{} >= '{{partition_start}}' and {} < '{{partition_end}}'".format(column, column)
+
+
+song_merge = MergeSpec(target='songs',
+                       source="""select song_id, title, artist_id, year, duration
+                                   from stg_songs""",
+                       columns=['song_id', 'title', 'artist_id', 'year', 'duration'],
+                       keys=['song_id'],
+                       latest_by=['year', 'duration', 'title', 'artist_id'])
+
+# an artist staged with several name / location variants is merged once,
+# preferring the variant with a location
+artist_merge = MergeSpec(target='artists',
+                         source="""select artist_id,
+                                          artist_name,
+                                          artist_location as location,
+                                          artist_latitude as latitude,
+                                          artist_longitude as longitude
+                                     from stg_songs""",
+                         columns=['artist_id', 'artist_name', 'location', 'latitude', 'longitude'],
+                         keys=['artist_id'],
+                         latest_by=['location', 'latitude', 'longitude', 'artist_name'])
+
+# a user can change level within the data being loaded; the latest event wins
+user_merge = MergeSpec(target='users',
+                       source="""select user_id, first_name, last_name, gender, level, start_time
+                                   from stg_plays
+                                  where {}""".format(_partition_filter('start_time')),
+                       columns=['user_id', 'first_name', 'last_name', 'gender', 'level'],
+                       keys=['user_id'],
+                       update=['level'],
+                       latest_by=['start_time', 'level', 'first_name', 'last_name', 'gender'])
+
+# calendar attributes come from the precomputed calendar_hours lookup
+time_merge = MergeSpec(target='time',
+                       source="""select e.start_time,
+                                        c.hour, c.day, c.week, c.month, c.year, c.weekday
+                                   from (select distinct start_time
+                                           from stg_plays
+                                          where {}) e
+                                   join calendar_hours c
+                                     on c.hour_start = date_trunc('hour', e.start_time)""".format(_partition_filter('start_time')),
+                       columns=['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+                       keys=['start_time'],
+                       latest_by=['start_time'],
+                       target_filter=_partition_filter('t.start_time'))
+
+# song_match is maintained after the songs & artists merges, for the songs
+# of this load only; one song is kept per key
+_song_match_source = """select {} as match_key, s.song_id, s.artist_id
+                          from songs s
+                          join artists a on a.artist_id = s.artist_id""".format(
+    match_key_sql('s.title', 'a.artist_name', 's.duration'))
+song_match_merge = MergeSpec(target='song_match',
+                             source=_song_match_source + "\n where s.song_id in (select song_id from stg_songs)",
+                             columns=['match_key', 'song_id', 'artist_id'],
+                             keys=['match_key'],
+                             latest_by=['song_id', 'artist_id'])
+# one-time backfill for the songs merged before song_match existed : every
+# song of the catalog, missing keys only, run by create_tables.py after the
+# schema migration
+song_match_backfill_merge = MergeSpec(target='song_match',
+                                      source=_song_match_source,
+                                      columns=song_match_merge.columns,
+                                      keys=song_match_merge.keys,
+                                      latest_by=song_match_merge.latest_by)
+
+# plays are matched to songs on title, artist name and duration, through
+# the match key computed by the refinement
+songplay_merge = MergeSpec(target='songplays',
+                           source="""SELECT a.start_time, a.user_id, a.level, m.song_id,
+                                            m.artist_id, a.session_id,
+                                            a.location, a.user_agent
+                                       from stg_plays a
+                                       join song_match m
+                                         on m.match_key = a.match_key
+                                      where {}""".format(_partition_filter('a.start_time')),
+                           columns=['start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                                    'session_id', 'location', 'user_agent'],
+                           keys=['start_time', 'user_id', 'session_id'],
+                           latest_by=['level', 'song_id', 'artist_id', 'location', 'user_agent'],
+                           target_filter=_partition_filter('t.start_time'))
+
+song_stg_table_create,     song_table_merge,     song_stg_table_drop     = merge_statements(song_merge)
+artist_stg_table_create,   artist_table_merge,   artist_stg_table_drop   = merge_statements(artist_merge)
+user_stg_table_create,     user_table_merge,     user_stg_table_drop     = map(SqlTemplate, merge_statements(user_merge))
+time_stg_table_create,     time_table_merge,     time_stg_table_drop     = map(SqlTemplate, merge_statements(time_merge))
+song_match_stg_table_create, song_match_table_merge, song_match_stg_table_drop = merge_statements(song_match_merge)
+song_match_backfill_stg_table_create, song_match_backfill_table_merge, _ = merge_statements(song_match_backfill_merge)
+songplay_stg_table_create, songplay_table_merge, songplay_stg_table_drop = map(SqlTemplate, merge_statements(songplay_merge))
+
+# songs & artists limited to the keys dimcache.py found new or changed
+song_changed_stg_table_create,   song_changed_table_merge,   _ = merge_statements(changed_keys_spec(song_merge, 'songs'))
+artist_changed_stg_table_create, artist_changed_table_merge, _ = merge_statements(changed_keys_spec(artist_merge, 'artists'))
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, song_match_table_create, calendar_table_create, run_ledger_table_create, quality_table_create, changed_keys_table_create, plays_table_create]
+drop_table_queries = rollup_drop_queries + [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, song_match_table_drop, calendar_table_drop, run_ledger_table_drop, quality_table_drop, changed_keys_table_drop, plays_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [song_table_insert, artist_table_insert, user_table_insert, time_table_insert, songplay_table_insert]
-song_table      = [song_stg_table_create, song_table_delete, song_table_insert, song_stg_table_drop]
-artist_table    = [artist_stg_table_create, artist_table_delete, artist_table_insert, artist_stg_table_drop]
-user_table      = [user_stg_table_create, user_table_update, user_table_delete, user_table_insert, user_stg_table_drop]
-time_table      = [time_stg_table_create, time_table_delete, time_table_insert, time_stg_table_drop]
-songplay_table  = [songplay_stg_table_create, songplay_table_delete, songplay_table_insert, songplay_stg_table_drop]
-process_table   = [song_table, artist_table, user_table, time_table, songplay_table]
\ No newline at end of file
+# The COPYs below are keyed by feed name; the feeds load into different
+# staging tables and are run at the same time, each on its own session.
+copy_table_feeds = {
+    'log_data'  : staging_events_copy,
+    'song_data' : staging_songs_copy,
+}
+# LOAD_FORMAT -> COPY statements of pre-processed chunks
+preprocessed_copy_queries = {
+    'csv'     : {'log_data' : staging_events_csv_copy,     'song_data' : staging_songs_csv_copy},
+    'parquet' : {'log_data' : staging_events_parquet_copy, 'song_data' : staging_songs_parquet_copy},
+}
+truncate_staging_queries = [staging_events_truncate, staging_songs_truncate]
+# feed name -> manifest COPY template; the feed name is also the RunContext
+# key of its source prefix
+incremental_copy_feeds = {
+    'log_data'  : staging_events_manifest_copy,
+    'song_data' : staging_songs_manifest_copy,
+}
+packed_copy_feeds = {
+    'log_data'  : staging_events_packed_copy,
+    'song_data' : staging_songs_packed_copy,
+}
+
+
+def staging_copy_feeds(load_format='json', load_mode='full'):
+    """This function returns the COPY templates (feed -> template) the load
+    of etl.load_from_config() runs for LOAD_FORMAT / LOAD_MODE of [ETL]
+    """
+    if load_format in preprocessed_copy_queries:
+        return preprocessed_copy_queries[load_format]
+    if load_mode == 'incremental':
+        return incremental_copy_feeds
+    if load_mode == 'planned':
+        return packed_copy_feeds
+    return copy_table_feeds
+
+
+insert_table_queries = [song_table_merge, artist_table_merge, user_table_merge, time_table_merge, song_match_table_merge, songplay_table_merge]
+# the rollups are refreshed once songplays is merged; Redshift applies only
+# the songplays rows added since the previous refresh
+aggregate_table = [rollup.refresh_sql() for rollup in rollups]
+# every chain first drops a work table a failed earlier chain may have left
+# on the same pooled session
+refine_events   = [refine_events_truncate, refine_events_insert, refine_events_analyze]
+song_table      = [song_stg_table_drop, song_stg_table_create, song_table_merge, song_stg_table_drop]
+artist_table    = [artist_stg_table_drop, artist_stg_table_create, artist_table_merge, artist_stg_table_drop]
+user_table      = [user_stg_table_drop, user_stg_table_create, user_table_merge, user_stg_table_drop]
+time_table      = [time_stg_table_drop, time_stg_table_create, time_table_merge, time_stg_table_drop]
+song_match_table = [song_match_stg_table_drop, song_match_stg_table_create, song_match_table_merge, song_match_stg_table_drop]
+song_match_backfill = [song_match_stg_table_drop, song_match_backfill_stg_table_create, song_match_backfill_table_merge, song_match_stg_table_drop]
+songplay_table  = [songplay_stg_table_drop, songplay_stg_table_create, songplay_table_merge, songplay_stg_table_drop]
+process_table   = [refine_events, song_table, artist_table, user_table, time_table, song_match_table, songplay_table, aggregate_table]
+
+# Dependency graph of the merge chains in process_table.
+# songs, artists, users and time are independent of each other and can be
+# merged at the same time, users & time once the events are refined; the
+# song_match lookup is built from songs & artists, and songplays is matched
+# through it. The rollups are refreshed
+# last, once every partition of songplays is merged.
+process_table_graph = {
+    'refine_events'    : [],
+    'song_table'       : [],
+    'artist_table'     : [],
+    'user_table'       : ['refine_events'],
+    'time_table'       : ['refine_events'],
+    'song_match_table' : ['song_table', 'artist_table'],
+    'songplay_table'   : ['song_match_table', 'refine_events'],
+    'aggregate_table'  : ['songplay_table'],
+}
+# dimensions checked against the local digest cache (dimcache.py) : chain
+# name -> MergeSpec, the chain limited to the changed keys, and the chains
+# built only from them, skipped when none of their inputs changed
+cached_dimensions = {
+    'song_table'   : song_merge,
+    'artist_table' : artist_merge,
+}
+changed_key_chains = {
+    'song_table'   : [song_stg_table_drop, song_changed_stg_table_create, song_changed_table_merge, song_stg_table_drop],
+    'artist_table' : [artist_stg_table_drop, artist_changed_stg_table_create, artist_changed_table_merge, artist_stg_table_drop],
+}
+cached_derived_chains = {
+    'song_match_table' : ['song_table', 'artist_table'],
+}
+# WLM execution profiles (profiles.py) : statement -> Profile. Every etl
+# statement runs in the 'etl' query group with the session slot count; the
+# joins staging the most rows take more slots so they do not spill, and the
+# merges name the targets to ANALYZE / VACUUM SORT ONLY after the run when
+# svv_table_info shows drift.
+query_profiles = {
+    refine_events_insert           : Profile('etl', slot_count=3),
+    songplay_stg_table_create      : Profile('etl', slot_count=2),
+    user_stg_table_create          : Profile('etl', slot_count=2),
+    time_stg_table_create          : Profile('etl', slot_count=2),
+    song_match_stg_table_create    : Profile('etl', slot_count=2),
+    song_table_merge               : Profile('etl', analyze='songs'),
+    song_changed_table_merge       : Profile('etl', analyze='songs'),
+    artist_table_merge             : Profile('etl', analyze='artists'),
+    artist_changed_table_merge     : Profile('etl', analyze='artists'),
+    user_table_merge               : Profile('etl', analyze='users'),
+    time_table_merge               : Profile('etl', analyze='time', vacuum='time'),
+    song_match_table_merge         : Profile('etl', analyze='song_match'),
+    songplay_table_merge           : Profile('etl', analyze='songplays', vacuum='songplays'),
+}
+# chains run once per partition (day of events), after the other chains
+partitioned_chains = ['user_table', 'time_table', 'songplay_table']
+process_table_chains = {
+    'refine_events'    : refine_events,
+    'song_table'       : song_table,
+    'artist_table'     : artist_table,
+    'user_table'       : user_table,
+    'time_table'       : time_table,
+    'song_match_table' : song_match_table,
+    'songplay_table'   : songplay_table,
+    'aggregate_table'  : aggregate_table,
+}
+
+# statement text -> variable name, used to label instrumented executions
+query_names = statement_names(globals())
+query_names.update({rollup.refresh_sql(): 'refresh_' + rollup.name for rollup in rollups})
+query_names.update({rollup.drop_sql(): 'drop_' + rollup.name for rollup in rollups})